@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+import numpy as np
+import SimpleITK as sitk
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import importlib.metadata
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import pub_mrf
+from pub_mrf import VoteCounter, PUB_MRF, Profiler
+
+def touch(counter):
+    """Write to every page of the vote array so that the page faults of the
+    first access are not counted in the timings."""
+    
+    counter.votes.fill(0)
+    return counter
+    
+def count_votes_per_label(votes, label_values, label_arrays):
+    """Count the votes with one scan of each image per label. This is the
+    vote counting of the original Scripts/pub_mrf.py, kept as a baseline."""
+    
+    for label_array in label_arrays:
+        for i, value in enumerate(label_values):
+            votes[i][np.where(label_array.ravel() == value)] += 1
+    
+def count_votes_single_pass(counter, label_arrays):
+    """Count the votes with the lookup table of the VoteCounter."""
+    
+    for label_array in label_arrays:
+        counter.add(label_array)
+        
+def random_label_arrays(n_voxels, n_labels, n_candidates, run_length, rng):
+    """Get random label arrays made of runs of identical labels, which is
+    closer to the layout of real segmentations than independent voxels."""
+    
+    dtype = np.uint8 if n_labels <= 256 else np.uint16
+    n_runs = n_voxels // run_length + 1
+    return [np.repeat(rng.randint(0, n_labels, n_runs), run_length)[:n_voxels].astype(dtype)
+            for n in range(n_candidates)]
+    
+def benchmark_votes(voxels, labels, n_candidates, run_length, repeats, baseline, seed=0):
+    """Time the vote counting for each combination of number of voxels and
+    number of labels. The vote array is allocated and written once outside
+    of the timed region, so only the counting itself is measured. Yield one row of
+    results for each combination and each counting method."""
+    
+    rng = np.random.RandomState(seed)
+    
+    for n_voxels in voxels:
+        for n_labels in labels:
+            label_arrays = random_label_arrays(n_voxels, n_labels, n_candidates, run_length, rng)
+            label_values = np.arange(n_labels, dtype=label_arrays[0].dtype)
+            
+            methods = [("single-pass", lambda: touch(VoteCounter(label_values, n_voxels)),
+                        lambda counter: count_votes_single_pass(counter, label_arrays))]
+            if baseline:
+                methods.append(("per-label", lambda: np.full((n_labels, n_voxels), 0, dtype=np.float32),
+                                lambda votes: count_votes_per_label(votes, label_values, label_arrays)))
+            
+            for name, setup, method in methods:
+                elapsed = []
+                for r in range(repeats): #keep the best time to reduce the noise
+                    state = setup()
+                    start = time.perf_counter()
+                    method(state)
+                    elapsed.append(time.perf_counter() - start)
+                    del state
+                    
+                seconds = min(elapsed)
+                yield name, n_voxels, n_labels, n_candidates, seconds, 1e9*seconds/(n_voxels*n_candidates)
+                
+def random_phantom(size, n_labels, n_candidates, noise, rng, disagreement=0.03):
+    """Get a synthetic brain image and candidate segmentations on a cube of
+    the given edge length. The labels are concentric shells, so there are
+    n_labels - 1 structures around the background, and each candidate moves
+    the shell boundaries by a smooth random amount, so that the candidates
+    disagree near the boundaries like registered atlases. The disagreement is
+    the amplitude of these moves as a fraction of the phantom radius, and the
+    noise is the standard deviation of the Gaussian noise of the intensities,
+    which are 100 apart between neighbouring structures."""
+    
+    center = (size - 1) / 2.0
+    z, y, x = np.indices((size, size, size)) - center
+    radius = np.sqrt(x*x + y*y + z*z) / (0.3*size) #the outer shell stays away from the edges
+    bounds = np.linspace(0.0, 1.0, n_labels)[1:]
+    
+    candidates = []
+    for n in range(n_candidates):
+        a, b, c = rng.uniform(0, 2*np.pi, 3)
+        shift = disagreement*(np.sin(6*x/size + a) + np.sin(6*y/size + b) + np.sin(6*z/size + c))
+        labels = (n_labels - 1 - np.searchsorted(bounds, radius + shift)).clip(0)
+        candidates.append(sitk.GetImageFromArray(labels.astype(np.uint8)))
+        
+    truth = (n_labels - 1 - np.searchsorted(bounds, radius)).clip(0)
+    brain = 100.0*truth + rng.normal(0.0, noise, truth.shape)
+    return sitk.GetImageFromArray(brain.astype(np.float32)), candidates
+    
+def get_batch_runner(model, chunk_size):
+    """Return a function which runs the batch engine on all the chunks of
+    low-confidence voxels of a model."""
+    
+    chunks = [(start, min(start + chunk_size, model.lcv.shape[0])) for start in range(0, model.lcv.shape[0], chunk_size)]
+    
+    def run_batch():
+        for start, stop in chunks:
+            model.update_probability(start, *model.mrf_potentials_batch(start, stop))
+            
+    return run_batch
+    
+def time_first_call(size, n_labels, n_candidates, patch_length, chunk_size, backend, seed):
+    """Time the first run of the batch engine with a backend on a synthetic
+    phantom, which is the cost of a single fusion. With Numba, this includes
+    its import and the loading of the compiled kernel. This is meant to run
+    in a fresh process, where Numba is not imported yet."""
+    
+    brain, candidates = random_phantom(size, n_labels, n_candidates, 20.0, np.random.RandomState(seed))
+    model = PUB_MRF(candidates, brain, patch_length=patch_length, chunk_size=chunk_size, backend="numpy")
+    model.find_lcv()
+    model.backend = backend
+    run_batch = get_batch_runner(model, chunk_size)
+    start = time.perf_counter()
+    run_batch()
+    return {"seconds": time.perf_counter() - start}
+    
+def benchmark_backends(sizes, n_labels, n_candidates, patch_length, chunk_size, repeats, baseline, seed=0):
+    """Time the MRF energies of the low-confidence voxels with each backend
+    of the batch engine, and optionally with the voxel engine, on synthetic
+    phantoms. The low-confidence voxels and the patch stats are computed
+    once outside of the timed region. The best time leaves out the first
+    call of the Numba backend, which compiles or loads the kernel, so the
+    first call of each batch backend is also timed in a fresh process.
+    Yield one row of results for each size and each backend."""
+    
+    for size in sizes:
+        brain, candidates = random_phantom(size, n_labels, n_candidates, 20.0, np.random.RandomState(seed))
+        model = PUB_MRF(candidates, brain, patch_length=patch_length, chunk_size=chunk_size, backend="numpy")
+        model.find_lcv()
+        run_batch = get_batch_runner(model, chunk_size)
+                
+        def run_voxel():
+            for model.lcv_index in range(model.lcv.shape[0]):
+                model.get_patch_stats()
+                model.mrf_potentials()
+                
+        methods = [("numpy", run_batch)]
+        if pub_mrf.numba_installed:
+            methods.append(("numba", run_batch))
+        if baseline:
+            methods.append(("voxel", run_voxel))
+            
+        for name, method in methods:
+            first_seconds = None
+            if name != "voxel":
+                first_seconds = run_isolated(time_first_call, (size, n_labels, n_candidates, patch_length,
+                                                               chunk_size, name, seed), 1)["seconds"]
+                
+            model.backend = "numba" if name == "numba" else "numpy"
+            if name == "numba": #compile the kernel
+                model.mrf_potentials_batch(0, min(chunk_size, model.lcv.shape[0]))
+                
+            elapsed = []
+            for r in range(repeats): #keep the best time to reduce the noise
+                start = time.perf_counter()
+                method()
+                elapsed.append(time.perf_counter() - start)
+                
+            seconds = min(elapsed)
+            yield name, size**3, model.lcv.shape[0], n_labels, first_seconds, seconds, 1e6*seconds/max(model.lcv.shape[0], 1)
+            
+@contextmanager
+def record_peak_rss(result):
+    """Set the peak_rss_mb of a result to the peak resident memory of the
+    process after the block, and its fusion_rss_mb to the growth of the peak
+    during the block. This is meant for a run in a fresh process from
+    run_isolated, so that the peak is the one of this run only."""
+    
+    profiler = Profiler()
+    baseline_rss = profiler.get_peak_rss()
+    yield
+    result["peak_rss_mb"] = profiler.get_peak_rss()
+    result["fusion_rss_mb"] = None
+    if baseline_rss is not None:
+        result["fusion_rss_mb"] = result["peak_rss_mb"] - baseline_rss
+        
+def run_isolated(function, args, repeats, timeout=None):
+    """Call function(*args) repeats times, each time in a new process, and
+    return the result with the best seconds, or the first result without
+    seconds, which stops the repetitions. The function returns a dict. A
+    call which takes more than timeout seconds is stopped, and gives a
+    result with the timeout status and no seconds."""
+    
+    context = multiprocessing.get_context("spawn") #nothing inherited from this process
+    results = []
+    for r in range(repeats):
+        with context.Pool(1) as pool: #the pool is terminated on exit, also after a timeout
+            job = pool.apply_async(function, args)
+            try:
+                results.append(job.get(timeout))
+            except multiprocessing.TimeoutError:
+                return {"status": "timeout", "message": "stopped after {} seconds".format(timeout), "seconds": None}
+        if results[-1]["seconds"] is None:
+            return results[-1]
+    return min(results, key=lambda result: result["seconds"])
+    
+def fuse_phantom(size, n_labels, n_candidates, disagreement, noise, seed, params):
+    """Run PUB-MRF once on a synthetic phantom, and return the result as a
+    dict. The phantom is generated outside of the timed region, so the
+    fusion memory is the growth of the peak over the memory held once the
+    phantom is generated."""
+    
+    rng = np.random.RandomState(seed)
+    brain, candidates = random_phantom(size, n_labels, n_candidates, noise, rng, disagreement)
+    
+    result = {"size": size, "voxels": size**3, "candidates": n_candidates, "labels": n_labels,
+              "disagreement": disagreement, "noise": noise, "seed": seed}
+    profiler = Profiler()
+    with record_peak_rss(result):
+        start = time.perf_counter()
+        PUB_MRF(candidates, brain, profiler=profiler, **params).run()
+        result["seconds"] = time.perf_counter() - start
+    report = profiler.get_report()
+    
+    result["bbox_voxels"], result["lcv"] = report["counts"]["bbox_voxels"], report["counts"]["lcv"]
+    result["lcv_fraction"] = result["lcv"] / float(result["bbox_voxels"])
+    result["stages"] = dict((stage["name"], stage["wall_seconds"]) for stage in report["stages"])
+    return result
+    
+def get_scaling_configs(sizes, candidates, labels, disagreements):
+    """Get the phantom configurations of the scaling benchmark as a list of
+    (size, labels, candidates, disagreement). One factor varies at a time,
+    the others keep their first value, so that each factor gives its own
+    scaling curve through the same base configuration."""
+    
+    base = (sizes[0], labels[0], candidates[0], disagreements[0])
+    configs = [base]
+    for axis, values in enumerate([sizes, labels, candidates, disagreements]):
+        for value in values:
+            config = base[:axis] + (value,) + base[axis + 1:]
+            if config not in configs:
+                configs.append(config)
+    return configs
+    
+def benchmark_scaling(sizes, candidates, labels, disagreements, noise, repeats, params, seed=0):
+    """Time PUB-MRF and measure its peak memory on synthetic phantoms, against
+    the volume size, the number of candidates, the number of labels and the
+    disagreement of the candidates, which sets the fraction of low-confidence
+    voxels. Each run gets its own process. Yield the result of the fastest
+    repetition of each configuration."""
+    
+    for size, n_labels, n_candidates, disagreement in get_scaling_configs(sizes, candidates, labels, disagreements):
+        yield run_isolated(fuse_phantom, (size, n_labels, n_candidates, disagreement, noise, seed, params), repeats)
+        
+def get_numba_version():
+    """Return the version of Numba without importing it, or None if it is not
+    installed."""
+    
+    try:
+        return importlib.metadata.version("numba")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+        
+def get_environment():
+    """Return a description of the machine and the library versions, to
+    compare results from different runs."""
+    
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "cpus": multiprocessing.cpu_count(),
+            "numpy": np.__version__, "simpleitk": sitk.Version_VersionString(),
+            "numba": get_numba_version()}
+            
+            
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""Benchmark PUB-MRF on synthetic data. With votes, time the vote
+                            counting on random label arrays. The single-pass counting should scale linearly
+                            with the number of voxels, and the time per voxel should not depend on the number
+                            of labels. With backends, time the MRF energies of the low-confidence voxels with
+                            each backend on synthetic phantoms, and the first call in a fresh process, which
+                            includes the loading of the Numba kernel. With scaling, time the whole fusion and
+                            measure its peak memory on synthetic phantoms, varying one of the size, number of
+                            candidates, number of labels and disagreement at a time.""")
+                            
+    parser.add_argument("benchmark", nargs="?", choices=["votes", "backends", "scaling"], default="votes",
+                        help="benchmark to run [default = %(default)s]")
+    parser.add_argument("--voxels", type=int, nargs="+", default=[100000, 400000, 1600000],
+                        help="numbers of voxels in the bounding box [default = %(default)s]")
+    parser.add_argument("--labels", type=int, nargs="+", default=[3, 30, 130],
+                        help="numbers of labels, including background [default = %(default)s]")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[21],
+                        help="numbers of candidate segmentations [default = %(default)s]")
+    parser.add_argument("--run_length", type=int, default=32,
+                        help="length of the runs of identical labels [default = %(default)s]")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="number of repetitions, the best time is kept [default = %(default)s]")
+    parser.add_argument("--baseline", action="store_true", default=False,
+                        help="also time the per-label vote counting, or the voxel engine")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 96, 128],
+                        help="edge lengths of the phantoms [default = %(default)s]")
+    parser.add_argument("--phantom_labels", type=int, nargs="+", default=[6],
+                        help="numbers of labels of the phantoms, including background [default = %(default)s]")
+    parser.add_argument("--disagreements", type=float, nargs="+", default=[0.03],
+                        help="""amplitudes of the boundary moves of the phantom candidates, as a fraction of the
+                        phantom radius [default = %(default)s]""")
+    parser.add_argument("--noise", type=float, default=20.0,
+                        help="""standard deviation of the noise of the phantom intensities, which are 100 apart
+                        between structures [default = %(default)s]""")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="LCV threshold for scaling [default = %(default)s]")
+    parser.add_argument("--patch_length", type=int, default=5,
+                        help="patch length for backends [default = %(default)s]")
+    parser.add_argument("--chunk_size", type=int, default=4096,
+                        help="chunk size of the batch engine [default = %(default)s]")
+    parser.add_argument("--json", type=str, default=None,
+                        help="""also write the scaling results, with the stage times and a description of the
+                        machine, to this JSON file [default = %(default)s]""")
+                        
+    opt = parser.parse_args()
+    
+    if opt.benchmark == "votes":
+        print("method,voxels,labels,candidates,seconds,ns_per_voxel")
+        for n_candidates in opt.candidates:
+            for row in benchmark_votes(opt.voxels, opt.labels, n_candidates, opt.run_length, opt.repeats, opt.baseline):
+                print("{},{},{},{},{:.4f},{:.2f}".format(*row))
+    elif opt.benchmark == "backends":
+        print("backend,voxels,lcv,labels,first_seconds,seconds,us_per_lcv")
+        for n_labels in opt.phantom_labels:
+            for n_candidates in opt.candidates:
+                for row in benchmark_backends(opt.sizes, n_labels, n_candidates, opt.patch_length,
+                                              opt.chunk_size, opt.repeats, opt.baseline):
+                    print("{},{},{},{},{},{:.4f},{:.2f}".format(*row[:4], "" if row[4] is None else "{:.4f}".format(row[4]), *row[5:]))
+    else:
+        params = {"patch_length": opt.patch_length, "chunk_size": opt.chunk_size, "threshold": opt.threshold}
+        results = []
+        print("voxels,candidates,labels,disagreement,bbox_voxels,lcv_fraction,seconds,ns_per_voxel,peak_rss_mb,fusion_rss_mb")
+        for result in benchmark_scaling(opt.sizes, opt.candidates, opt.phantom_labels, opt.disagreements,
+                                        opt.noise, opt.repeats, params):
+            results.append(result)
+            print("{},{},{},{},{},{:.4f},{:.4f},{:.2f},{:.1f},{}".format(
+                  result["voxels"], result["candidates"], result["labels"], result["disagreement"],
+                  result["bbox_voxels"], result["lcv_fraction"], result["seconds"],
+                  1e9*result["seconds"]/result["bbox_voxels"], result["peak_rss_mb"],
+                  "" if result["fusion_rss_mb"] is None else "{:.1f}".format(result["fusion_rss_mb"])))
+            sys.stdout.flush()
+            
+        if opt.json is not None:
+            with open(opt.json, "w") as f:
+                json.dump({"schema": "pub_mrf.benchmark.scaling/1", "command": sys.argv[1:],
+                           "environment": get_environment(), "parameters": params,
+                           "results": results}, f, indent=1)
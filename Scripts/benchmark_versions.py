@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+import numpy as np
+import SimpleITK as sitk
+
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from contextlib import redirect_stdout
+import fnmatch
+import glob
+import importlib.util
+import inspect
+import io
+import json
+import os.path
+import re
+import sys
+import time
+
+from pub_mrf import get_bounding_box, get_image_array, prefetch, read_image_information, union_bounding_box
+from benchmark_pub_mrf import get_environment, record_peak_rss, run_isolated
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+VERSIONS_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), "Versions")
+
+def get_version_name(filename):
+    """Return the version number of a file of the Versions directory, or
+    current for the pub_mrf.py of this directory."""
+
+    match = re.match(r"pub_mrf(\d+(\.\d+)*)\.py$", os.path.basename(filename))
+    return match.group(1) if match is not None else "current"
+
+def find_versions(directory, patterns=None):
+    """Return the files of the versions in a directory, sorted by version
+    number, keeping only the versions which match one of the patterns."""
+
+    filenames = [f for f in glob.glob(os.path.join(directory, "pub_mrf*.py")) if get_version_name(f) != "current"]
+    filenames.sort(key=lambda f: [int(x) for x in get_version_name(f).split(".")])
+    if patterns is not None:
+        filenames = [f for f in filenames if any(fnmatch.fnmatch(get_version_name(f), p) for p in patterns)]
+    return filenames
+
+def load_fusion_class(filename, candidate_files):
+    """Import a version from its file and return its fusion class, which is
+    PUB_MRF or AWoL_MRF. A few versions use the opt of their command line
+    in the class, so the module gets one with the candidate files."""
+
+    name = "pub_mrf_" + get_version_name(filename).replace(".", "_")
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not hasattr(module, "opt"):
+        module.opt = Namespace(input_labels=candidate_files)
+
+    for class_name in ("PUB_MRF", "AWoL_MRF"):
+        if hasattr(module, class_name):
+            return getattr(module, class_name)
+    raise ValueError("No PUB_MRF or AWoL_MRF class in {}".format(filename))
+
+def ingest(candidate_files, brain_file, padding, prefetch_depth):
+    """Read the candidates and the brain image once for all the versions, and
+    crop them to the bounding box of the structures, padded by the given
+    number of voxels inside of the image. Return the cropped arrays with the
+    information of the cropped images, the bounding box and the full size."""
+
+    bbox = None
+    label_arrays = []
+    for filename, labelimg in zip(candidate_files, prefetch(sitk.ReadImage, candidate_files, prefetch_depth)):
+        label_array = sitk.GetArrayViewFromImage(labelimg)
+        new_bbox = get_bounding_box(label_array)
+        if new_bbox is None:
+            sys.exit("No structure found in {}".format(filename))
+        bbox = union_bounding_box(bbox, new_bbox)
+        label_arrays.append(sitk.GetArrayFromImage(labelimg))
+        del labelimg, label_array
+
+    brainimg = sitk.ReadImage(brain_file)
+    size = brainimg.GetSize()
+    bbox = [max(x - padding, 0) for x in bbox[:3]] + [min(x + padding, size[i]) for i, x in enumerate(bbox[3:])]
+
+    inputs = {"bbox": bbox, "size": size,
+              "spacing": brainimg.GetSpacing(), "direction": brainimg.GetDirection(),
+              "origin": brainimg.TransformIndexToPhysicalPoint(bbox[:3]), #origin of the cropped images
+              "labels": [np.ascontiguousarray(get_image_array(a, bbox)) for a in label_arrays],
+              "intensity": np.ascontiguousarray(get_image_array(brainimg, bbox))}
+    return inputs
+
+def get_image(array, inputs):
+    """Return a cropped array as a SimpleITK image with the information of
+    the cropped region."""
+
+    img = sitk.GetImageFromArray(array)
+    img.SetSpacing(inputs["spacing"])
+    img.SetOrigin(inputs["origin"])
+    img.SetDirection(inputs["direction"])
+    return img
+
+def get_empty_result(filename):
+    """Return the result of a version without any measurement."""
+
+    return {"version": get_version_name(filename), "file": filename, "status": "ok", "message": "",
+            "setup_seconds": None, "run_seconds": None, "seconds": None,
+            "peak_rss_mb": None, "fusion_rss_mb": None, "labels": None}
+
+def run_version(filename, candidate_files, inputs, params):
+    """Run a version once on the cropped inputs, and return the result as a
+    dict with the output labels. The setup is the constructor, which counts
+    the votes, and the run is the MRF update and the output image. Errors are
+    reported in the status of the result."""
+
+    result = get_empty_result(filename)
+    try:
+        fusion_class = load_fusion_class(filename, candidate_files)
+        arguments = inspect.signature(fusion_class.__init__).parameters
+        if "labelimg_list" not in arguments or "brainimg" not in arguments:
+            result["status"] = "unsupported"
+            result["message"] = "the class does not take candidate and brain images"
+            return result
+        kwargs = dict((name, value) for name, value in params.items() if name in arguments)
+
+        labelimg_list = [get_image(a, inputs) for a in inputs["labels"]]
+        brainimg = get_image(inputs["intensity"], inputs)
+
+        with record_peak_rss(result), redirect_stdout(io.StringIO()): #some versions print their progress
+            start = time.perf_counter()
+            model = fusion_class(labelimg_list, brainimg, **kwargs)
+            result["setup_seconds"] = time.perf_counter() - start
+            start = time.perf_counter()
+            output = model.run()
+            result["run_seconds"] = time.perf_counter() - start
+        result["seconds"] = result["setup_seconds"] + result["run_seconds"]
+        result["labels"] = sitk.GetArrayFromImage(output)
+
+    except Exception as e:
+        result["status"] = "failed"
+        result["message"] = "{}: {}".format(type(e).__name__, e)
+
+    return result
+
+def get_dice(reference, labels, outside_counts=None):
+    """Return the Dice coefficient of each structural label of a reference
+    array in the bounding box, from a single joint bincount of the reference
+    and the output labels. The counts of the reference labels outside of the
+    bounding box are added to the reference volumes, since the output labels
+    are background there."""
+
+    if labels.shape != reference.shape:
+        raise ValueError("output size {} not the same as the reference {}".format(labels.shape[::-1], reference.shape[::-1]))
+
+    labels = labels.astype(np.int64) #some versions write the labels as floats
+    n = int(max(reference.max(), labels.max())) + 1
+    if outside_counts is not None: #some reference labels may be only outside
+        n = max(n, outside_counts.shape[0])
+    joint = np.bincount(reference.astype(np.int64).ravel()*n + labels.ravel(), minlength=n*n).reshape(n, n)
+    reference_volumes = joint.sum(axis=1)
+    if outside_counts is not None:
+        reference_volumes[:outside_counts.shape[0]] += outside_counts
+    label_volumes = joint.sum(axis=0)
+
+    dice = {}
+    for value in np.nonzero(reference_volumes)[0]:
+        if value != 0:
+            dice[int(value)] = float(2.0*joint[value, value] / (reference_volumes[value] + label_volumes[value]))
+    return dice
+
+def get_cropped_reference(filename, inputs):
+    """Read a reference label image and return its array within the bounding
+    box, with the counts of its labels outside of the bounding box."""
+
+    header = read_image_information(filename)
+    if header.GetSize() != tuple(inputs["size"]):
+        sys.exit("Size of {0} not the same as the brain image".format(filename))
+
+    reference = sitk.GetArrayFromImage(sitk.ReadImage(filename))
+    if reference.min() < 0:
+        sys.exit("Negative labels in {0}".format(filename))
+    cropped = np.ascontiguousarray(get_image_array(reference, inputs["bbox"]))
+    counts = np.bincount(reference.ravel().astype(np.int64))
+    counts[:cropped.max() + 1] -= np.bincount(cropped.ravel().astype(np.int64))
+    return cropped, counts
+
+def benchmark_versions(filenames, candidate_files, inputs, params, repeats, timeout):
+    """Run each version on the same inputs, each repetition in its own
+    process, and yield the result of the fastest repetition of each version.
+    A repetition which takes more than timeout seconds is stopped."""
+
+    for filename in filenames:
+        result = get_empty_result(filename)
+        result.update(run_isolated(run_version, (filename, candidate_files, inputs, params), repeats, timeout))
+        yield result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""Compare the runtime, peak memory and accuracy of the versions of the
+                            fusion in the Versions directory, and of the current pub_mrf.py, on the same inputs.
+                            The candidates and the brain image are read and cropped once, and each version runs
+                            in its own process on the same cropped images. The accuracy is the Dice coefficient of
+                            each structural label against a reference segmentation, or against the output of the
+                            current version without one. Print a CSV line per version.""")
+
+    def parameter(x): #name=value
+        name, sep, value = x.partition("=")
+        if not sep or not name:
+            raise ArgumentTypeError("%r is not name=value"%(x,))
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass #keep the string
+        return name, value
+
+    parser.add_argument("--brain_image", type=str, required=True)
+    parser.add_argument("input_labels", type=str, nargs="+")
+    parser.add_argument("--reference", type=str, default=None,
+                        help="reference segmentation for the Dice coefficients [default = output of the current version]")
+    parser.add_argument("--versions", type=str, nargs="+", default=None,
+                        help="version numbers to run, shell patterns like 5.* are allowed [default = all]")
+    parser.add_argument("--versions_dir", type=str, default=VERSIONS_DIR,
+                        help="directory of the versions [default = %(default)s]")
+    parser.add_argument("--param", type=parameter, action="append", default=[],
+                        help="""parameter name=value given to the versions which take it, like alpha=1.0 or
+                        threshold=0.2, this option can be repeated [default = the defaults of each version]""")
+    parser.add_argument("--padding", type=int, default=None,
+                        help="""padding of the bounding box of the structures, in voxels, at least the patch length
+                        [default = the patch_length parameter, or 5]""")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="number of repetitions, the best time is kept [default = %(default)s]")
+    parser.add_argument("--timeout", type=float, default=3600.0,
+                        help="stop a version after this number of seconds [default = %(default)s]")
+    parser.add_argument("--min_dice", type=float, default=None,
+                        help="report the fastest version with at least this mean Dice coefficient [default = %(default)s]")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="number of candidate images decoded ahead of use [default = %(default)s]")
+    parser.add_argument("--json", type=str, default=None,
+                        help="""also write the results, with the Dice coefficient of each label and a description
+                        of the machine, to this JSON file [default = %(default)s]""")
+
+    opt = parser.parse_args()
+
+    for filename in opt.input_labels + [opt.brain_image] + ([opt.reference] if opt.reference else []):
+        if not os.path.exists(filename):
+            sys.exit("{} does not exist".format(filename))
+
+    params = dict(opt.param)
+    patch_length = int(params.get("patch_length", 5)) #the patches of the voxels must stay inside of the crop
+    padding = patch_length if opt.padding is None else opt.padding
+    if padding < patch_length:
+        sys.exit("The padding {} is smaller than the patch length {}".format(padding, patch_length))
+    inputs = ingest(opt.input_labels, opt.brain_image, padding, opt.prefetch)
+    filenames = [os.path.join(SCRIPTS_DIR, "pub_mrf.py")] + find_versions(opt.versions_dir, opt.versions)
+
+    reference, outside_counts = None, None
+    if opt.reference is not None:
+        reference, outside_counts = get_cropped_reference(opt.reference, inputs)
+
+    results = []
+    print("version,status,setup_seconds,run_seconds,seconds,peak_rss_mb,fusion_rss_mb,mean_dice,min_dice")
+    for result in benchmark_versions(filenames, opt.input_labels, inputs, params, opt.repeats, opt.timeout):
+        labels = result.pop("labels")
+        if reference is None and result["version"] == "current": #the current version runs first
+            if labels is None:
+                sys.exit("The current version failed: {}".format(result["message"]))
+            reference = labels
+
+        result["dice"], result["mean_dice"], result["min_dice"] = None, None, None
+        if labels is not None:
+            try:
+                dice = get_dice(reference, labels, outside_counts)
+                result["dice"] = dict((str(value), d) for value, d in dice.items())
+                result["mean_dice"] = float(np.mean(list(dice.values()))) if dice else None
+                result["min_dice"] = float(min(dice.values())) if dice else None
+            except ValueError as e:
+                result["status"], result["message"] = "failed", str(e)
+        results.append(result)
+
+        print(",".join("" if result[k] is None else "{:.4f}".format(result[k]) if isinstance(result[k], float) else str(result[k])
+                       for k in ("version", "status", "setup_seconds", "run_seconds", "seconds",
+                                 "peak_rss_mb", "fusion_rss_mb", "mean_dice", "min_dice")))
+        sys.stdout.flush()
+        if result["status"] != "ok":
+            print("Version {} {}: {}".format(result["version"], result["status"], result["message"]), file=sys.stderr)
+
+    fastest = None
+    if opt.min_dice is not None:
+        accurate = [r for r in results if r["status"] == "ok" and r["mean_dice"] is not None and r["mean_dice"] >= opt.min_dice]
+        if accurate:
+            fastest = min(accurate, key=lambda r: r["seconds"])["version"]
+        print("Fastest version with a mean Dice of at least {}: {}".format(opt.min_dice, fastest), file=sys.stderr)
+
+    if opt.json is not None:
+        with open(opt.json, "w") as f:
+            json.dump({"schema": "pub_mrf.benchmark.versions/1", "command": sys.argv[1:],
+                       "environment": get_environment(), "parameters": params, "bbox": inputs["bbox"],
+                       "reference": opt.reference, "min_dice": opt.min_dice, "fastest": fastest,
+                       "results": results}, f, indent=1)
@@ -8,7 +8,9 @@ from warnings import warn
 import os.path
 import sys
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Run the majority vote with the command line arguments, or with argv if it is given."""
+    
     parser = ArgumentParser()
     parser.add_argument("input_labels", nargs="+", type=str)
     parser.add_argument("output_labels", type=str)
@@ -19,7 +21,7 @@ if __name__ == "__main__":
                    help="opposite of '--clobber'")
     g.set_defaults(clobber=False)
 
-    opt = parser.parse_args()
+    opt = parser.parse_args(argv)
 
     if not(opt.clobber) and os.path.exists(opt.output_labels):
         sys.exit("Output file already exists; use --clobber to overwrite.")
@@ -97,3 +99,6 @@ if __name__ == "__main__":
     output_image.CopyInformation(labelimg) #copy the metadata
     
     sitk.WriteImage(output_image, opt.output_labels, True) #save the result to the output file
+
+if __name__ == "__main__":
+    main()
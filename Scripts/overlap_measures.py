@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import numpy as np
+import SimpleITK as sitk
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import glob
+import os.path
+import sys
+import time
+
+from pub_mrf import get_bounding_box, get_image_array, union_bounding_box
+
+#the columns of LabelOverlapMeasures, which are kept in the result table
+MEASURES = ("Total/Target", "Jaccard", "Dice", "VolumeSimilarity", "FalseNegative", "FalsePositive")
+
+def get_confusion_matrix(source, target):
+    """Return the label values of two label arrays and their confusion matrix,
+    where the entry (i, j) is the number of voxels with the label value i in
+    the source and j in the target. The label values are mapped to
+    consecutive indices with a lookup table, so that a single joint bincount
+    of the two arrays gives the whole matrix."""
+
+    source, target = source.ravel(), target.ravel()
+    if (source.dtype.kind == "i" and source.min() < 0) or (target.dtype.kind == "i" and target.min() < 0):
+        raise ValueError("negative label values")
+    source, target = source.astype(np.intp, copy=False), target.astype(np.intp, copy=False)
+
+    present = np.zeros(int(max(source.max(), target.max())) + 1, dtype=bool)
+    present[source] = True
+    present[target] = True
+    values = np.flatnonzero(present)
+
+    lut = np.zeros(present.shape[0], dtype=np.intp)
+    lut[values] = np.arange(values.shape[0])
+    n = values.shape[0]
+    confusion = np.bincount(lut[source]*n + lut[target], minlength=n*n).reshape(n, n)
+    return values, confusion
+
+def get_overlap_measures(source, target):
+    """Return the overlap measures of a source and a target label array, as
+    the rows of LabelOverlapMeasures: the row All for all the structural
+    labels together, then a row per label value other than 0. Each row is
+    (label, total/target, jaccard, dice, volume similarity, false negative,
+    false positive), with the same definitions as LabelOverlapMeasures. The
+    false positive is the fraction of the source label outside of the
+    target, which recent versions of ITK call the false discovery rate. The
+    measures of a label which is absent from both arrays are not defined."""
+
+    values, confusion = get_confusion_matrix(source, target)
+    structure = values != 0
+    intersection = np.diagonal(confusion)[structure].astype(np.float64)
+    source_volume = confusion.sum(axis=1)[structure].astype(np.float64)
+    target_volume = confusion.sum(axis=0)[structure].astype(np.float64)
+
+    def measures(inter, s, t): #works on arrays of labels or on the sums for All
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (inter / t, inter / (s + t - inter), 2.0*inter / (s + t),
+                    2.0*(s - t) / (s + t), (t - inter) / t, (s - inter) / s)
+
+    rows = [("All",) + tuple(float(m) for m in measures(intersection.sum(), source_volume.sum(), target_volume.sum()))]
+    per_label = measures(intersection, source_volume, target_volume)
+    for i, value in enumerate(values[structure]):
+        rows.append((int(value),) + tuple(float(m[i]) for m in per_label))
+    return rows
+
+def read_label_array(filename):
+    """Return the label array of an image file."""
+
+    return sitk.GetArrayFromImage(sitk.ReadImage(filename))
+
+@lru_cache(maxsize=4)
+def read_target(filename):
+    """Return the label array of a manual segmentation with the bounding box
+    of its structures. Many outputs share the same manual segmentation, so
+    the last ones read by a worker are kept."""
+
+    target = read_label_array(filename)
+    return target, get_bounding_box(target)
+
+def evaluate(source_filename, target_filename):
+    """Return the overlap measures of a fusion output against a manual
+    segmentation. Both images are cropped to the bounding box of the
+    structures of either, since the background voxels of both images do not
+    change any measure."""
+
+    source = read_label_array(source_filename)
+    target, target_bbox = read_target(target_filename)
+    if source.shape != target.shape:
+        raise ValueError("size of {0} not the same as {1}".format(source_filename, target_filename))
+
+    bbox = union_bounding_box(get_bounding_box(source), target_bbox)
+    if bbox is None: #no structure at all
+        bbox = [0, 0, 0, 1, 1, 1]
+    return get_overlap_measures(get_image_array(source, bbox), get_image_array(target, bbox))
+
+def get_jobs(dataset, algorithm, pattern, fields, target_format):
+    """Return the (output file, field values, manual segmentation file) of
+    each fusion output of an algorithm. The file names start with the given
+    fields and the subject, separated by dashes, as written by the
+    random_trials scripts."""
+
+    jobs = []
+    for filename in sorted(glob.glob(os.path.join(dataset, "output", "fusion", algorithm, pattern))):
+        file_info = os.path.basename(filename).split("-")
+        if len(file_info) <= len(fields):
+            sys.exit("{} does not start with the {} fields and the subject".format(filename, ", ".join(fields)))
+        subject = file_info[len(fields)]
+        jobs.append((filename, file_info[:len(fields)], target_format.format(dataset=dataset, subject=subject)))
+    return jobs
+
+def run_job(job):
+    """Evaluate a job in a worker process, and return its result rows with
+    None, or no rows with the error message."""
+
+    filename, field_values, target_filename = job
+    try:
+        return [[os.path.basename(filename)] + field_values + list(row) for row in evaluate(filename, target_filename)], None
+    except Exception as e:
+        return [], "{}: {}".format(type(e).__name__, " ".join(str(e).split()))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""Compute the overlap measures of LabelOverlapMeasures for all the fusion
+                            outputs of an algorithm against the manual segmentations, and write them to a single
+                            CSV table. The measures of all the labels come from one confusion matrix, on the region
+                            of the structures, and the outputs are evaluated by a pool of worker processes.""")
+
+    parser.add_argument("dataset", type=str)
+    parser.add_argument("algorithm", type=str)
+    parser.add_argument("output", type=str, help="CSV table of the results")
+    parser.add_argument("--pattern", type=str, default="*",
+                        help="shell pattern of the output files in the fusion directory [default = %(default)s]")
+    parser.add_argument("--fields", type=str, nargs="*", default=["NumAtlas", "NumTemplate"],
+                        help="""names of the fields of the output file names before the subject, use NumAtlas
+                        only for the JLF outputs [default = %(default)s]""")
+    parser.add_argument("--target", type=str, default="{dataset}/input/atlases/labels/{subject}-t2_labels.mnc",
+                        help="manual segmentation of a subject [default = %(default)s]")
+    parser.add_argument("--append", action="store_true", default=False,
+                        help="""add the results to the end of an existing table, without a new header, instead of
+                        overwriting it""")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes [default = %(default)s]")
+
+    opt = parser.parse_args()
+
+    jobs = get_jobs(opt.dataset, opt.algorithm, opt.pattern, opt.fields, opt.target)
+    if not jobs:
+        sys.exit("No output found in {}".format(os.path.join(opt.dataset, "output", "fusion", opt.algorithm, opt.pattern)))
+
+    initial_time = time.time()
+    n_failed = 0
+    new_table = not opt.append or not os.path.exists(opt.output) or os.path.getsize(opt.output) == 0
+    with open(opt.output, "a" if opt.append else "w") as f, ProcessPoolExecutor(opt.jobs) as pool:
+        if new_table:
+            f.write(",".join(["FileName"] + opt.fields + ["Label"] + list(MEASURES)) + "\n")
+        for job, (rows, message) in zip(jobs, pool.map(run_job, jobs, chunksize=4)): #in the order of the files
+            if message is not None:
+                n_failed += 1
+                print("{} failed: {}".format(job[0], message))
+            for row in rows:
+                f.write(",".join(str(x) for x in row) + "\n")
+
+    print("{} outputs evaluated, {} failed, in {:.1f} seconds.".format(len(jobs), n_failed, time.time() - initial_time))
+    if n_failed > 0:
+        sys.exit(1)
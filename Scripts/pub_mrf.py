@@ -4,11 +4,971 @@ import numpy as np
 import SimpleITK as sitk
 
 from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from warnings import warn
+import hashlib
+import importlib.util
+import json
+import multiprocessing
 import os.path
+import shutil
 import sys
 import time
 
+try:
+    import resource
+except ImportError: #not available on Windows, the peak memory is not profiled
+    resource = None
+
+#the compiled backend is optional, and Numba is only imported when it is used
+numba_installed = importlib.util.find_spec("numba") is not None
+prange = range #numba.prange once the kernel is compiled
+compiled_kernel = None
+
+class VoteCounter:
+    """Accumulate the votes of the candidate segmentations, one image at a
+    time. Each label array is mapped to contiguous label indices through a
+    lookup table, and the votes are then counted in a single pass over the
+    voxels, so the cost of counting the votes from an image depends on the
+    number of voxels but not on the number of labels. With only a few labels,
+    one mask per label is added instead, which is faster than the scatter.
+    
+    The votes are stored as unsigned integer counts, using the narrowest type
+    which can hold the number of images added so far."""
+    
+    max_mask_labels = 8 #up to this number of labels, count with one mask per label
+    
+    def __init__(self, label_values, n_voxels):
+        self.label_values = np.asarray(label_values)
+        self.n_labels = self.label_values.shape[0]
+        self.n_voxels = n_voxels
+        self.voxels = np.arange(n_voxels)
+        self.lut = {}
+        self.n_images = 0
+        self.init_votes()
+        
+    def init_votes(self):
+        """Allocate the arrays which keep the vote counts."""
+        
+        self.votes = np.zeros((self.n_labels, self.n_voxels), dtype=np.uint8)
+        
+    def widen(self, counts):
+        """Return the count array with a wider type if the next image could
+        make the counts overflow."""
+        
+        if self.n_images == np.iinfo(counts.dtype).max:
+            return counts.astype(np.uint16 if counts.dtype == np.uint8 else np.uint32)
+        return counts
+            
+    def get_lut(self, dtype):
+        """Return the lookup table from label values to label indices for
+        label arrays of a given integer type. Unsigned types of 8 or 16 bits
+        are indexed directly, other integer types are clipped first."""
+        
+        if dtype not in self.lut:
+            if dtype.kind == "u" and dtype.itemsize <= 2:
+                offset = 0
+                size = 2**(8*dtype.itemsize) #one entry for each possible value
+            else:
+                offset = int(self.label_values[0]) - 1 #keep one entry on each side for unknown values
+                size = int(self.label_values[-1]) - offset + 2
+                
+            lut = np.zeros(size, dtype=np.intp) + self.n_labels
+            lut[self.label_values.astype(np.intp) - offset] = np.arange(self.n_labels)
+            self.lut[dtype] = (lut, offset)
+            
+        return self.lut[dtype]
+            
+    def label_index(self, label_array):
+        """Return the flattened array of label indices. The values which are
+        not in the list of labels are mapped to the index n_labels."""
+        
+        label_array = np.ravel(label_array)
+        
+        if label_array.dtype.kind in "ui" and self.label_values.dtype.kind in "ui":
+            lut, offset = self.get_lut(label_array.dtype)
+            if offset == 0 and lut.shape[0] == 2**(8*label_array.dtype.itemsize):
+                return lut[label_array]
+                
+            index = label_array.astype(np.intp) - offset
+            np.clip(index, 0, lut.shape[0] - 1, out=index) #unknown values go to the extra entries
+            return lut[index]
+        
+        #fall back to a binary search if the labels are not stored as integers
+        index = np.minimum(np.searchsorted(self.label_values, label_array), self.n_labels - 1)
+        index[self.label_values[index] != label_array] = self.n_labels
+        return index
+        
+    def add(self, label_array):
+        """Count the votes from a label array with the same number of voxels
+        as the vote array. Return the number of voxels found for each label,
+        with the voxels of unknown labels counted in the last entry."""
+        
+        index = self.label_index(label_array)
+        label_counts = np.bincount(index, minlength=self.n_labels + 1)
+        
+        if label_counts[-1] > 0: #unknown labels don't get any vote
+            known = index < self.n_labels
+            index, voxels = index[known], self.voxels[known]
+        else:
+            voxels = self.voxels
+        
+        self.count(index, voxels)
+        self.n_images += 1
+            
+        return label_counts
+        
+    def count(self, index, voxels):
+        """Add one vote for the label index of each voxel. With a few labels,
+        a pass over the voxels per label is faster than the scatter."""
+        
+        self.votes = self.widen(self.votes)
+        
+        if self.n_labels <= self.max_mask_labels and voxels.shape[0] == self.n_voxels:
+            for i in range(self.n_labels):
+                self.votes[i] += index == i
+            return
+        
+        #each voxel votes for exactly one label, so the flat indices are unique
+        index *= self.n_voxels
+        index += voxels
+        self.votes.reshape(-1)[index] += 1
+        
+    def gather_labels(self, labels, index):
+        """Return the vote counts of the given label indices at the given
+        voxels, two arrays which are broadcast together. The label index
+        n_labels marks an empty slot, which gets no vote."""
+        
+        votes = self.votes[np.minimum(labels, self.n_labels - 1), index]
+        return np.where(labels < self.n_labels, votes, 0)
+        
+    def candidates(self, index):
+        """Return the label indices and the vote counts of the labels which
+        receive votes at the given voxels, as two arrays of shape
+        (n_slots, number of voxels), where n_slots is the largest number of
+        such labels at one of the voxels. The labels of each voxel are in
+        increasing order, followed by empty slots with the label index
+        n_labels and no vote."""
+        
+        votes = self.votes[:, index]
+        columns, labels = np.nonzero(votes.T) #sorted by voxel, then by label
+        return self.get_slots(columns, labels, votes[labels, columns], votes.shape[1])
+        
+    def get_slots(self, columns, labels, counts, n_columns):
+        """Return the slot arrays of candidates from the (column, label,
+        count) entries of the labels with votes, sorted by column and then
+        by label."""
+        
+        rank = np.arange(columns.shape[0]) - np.searchsorted(columns, columns) #slot of each entry
+        n_slots = int(np.amax(rank, initial=-1)) + 1
+        slot_labels = np.zeros((n_slots, n_columns), dtype=np.intp) + self.n_labels
+        slot_counts = np.zeros((n_slots, n_columns), dtype=counts.dtype)
+        slot_labels[rank, columns] = labels
+        slot_counts[rank, columns] = counts
+        return slot_labels, slot_counts
+        
+    def count_labels(self):
+        """Return the number of labels which receive at least one vote at
+        each voxel."""
+        
+        return np.sum(self.votes > 0, axis=0)
+        
+    def max_votes(self):
+        """Return the largest vote count at each voxel."""
+        
+        return np.amax(self.votes, axis=0)
+        
+    def mode(self):
+        """Return the index of the majority vote label at each voxel. Ties
+        go to the smallest label index."""
+        
+        return np.argmax(self.votes, axis=0)
+        
+    def top_two(self):
+        """Return the index of the majority vote label at each voxel, with
+        the largest and the second largest vote counts."""
+        
+        mode = np.argmax(self.votes, axis=0)
+        first = self.votes[mode, self.voxels]
+        
+        if self.n_labels > 1:
+            second = np.partition(self.votes, self.n_labels - 2, axis=0)[self.n_labels - 2]
+        else:
+            second = np.zeros_like(first)
+            
+        return mode, first, second
+        
+        
+class SparseVoteCounter(VoteCounter):
+    """Accumulate the votes of the candidate segmentations, keeping at most
+    max_labels (label, count) pairs per voxel instead of a count for every
+    label. This is meant for atlases with many structures, where most voxels
+    only receive votes for a few labels. The votes for any additional label
+    at a voxel go to an overflow table, so no vote is ever lost.
+    
+    The memory used by the vote counts scales with max_labels rather than
+    with the number of labels."""
+    
+    def __init__(self, label_values, n_voxels, max_labels=4):
+        self.max_labels = int(max_labels)
+        VoteCounter.__init__(self, label_values, n_voxels)
+        
+    def init_votes(self):
+        """Allocate the label and count arrays, with one row per slot. The
+        label index n_labels marks the empty slots."""
+        
+        self.empty = self.n_labels
+        self.labels = np.zeros((self.max_labels, self.n_voxels), dtype=np.min_scalar_type(self.n_labels)) + self.empty
+        self.counts = np.zeros((self.max_labels, self.n_voxels), dtype=np.uint8)
+        
+        #overflow table, sorted by voxel and then by label
+        self.overflow_voxels = np.zeros(0, dtype=np.intp)
+        self.overflow_labels = np.zeros(0, dtype=np.intp)
+        self.overflow_counts = np.zeros(0, dtype=np.uint32)
+        
+    def count(self, index, voxels):
+        """Add one vote for the label index of each voxel. The label goes
+        to its slot if it already has one, otherwise to the first empty slot,
+        and to the overflow table if all the slots are taken."""
+        
+        self.counts = self.widen(self.counts)
+        
+        slots = self.labels[:, voxels]
+        found = slots == index
+        hit = found.any(axis=0)
+        self.counts[np.argmax(found[:, hit], axis=0), voxels[hit]] += 1
+        
+        if hit.all():
+            return
+            
+        index, voxels, slots = index[~hit], voxels[~hit], slots[:, ~hit]
+        free = slots == self.empty
+        has_free = free.any(axis=0)
+        slot = np.argmax(free[:, has_free], axis=0)
+        self.labels[slot, voxels[has_free]] = index[has_free]
+        self.counts[slot, voxels[has_free]] = 1
+        
+        if not has_free.all():
+            self.add_overflow(index[~has_free], voxels[~has_free])
+            
+    def add_overflow(self, index, voxels):
+        """Add one vote for each (label, voxel) pair to the overflow table."""
+        
+        keys = np.concatenate((self.overflow_voxels * self.n_labels + self.overflow_labels, 
+                               voxels.astype(np.intp) * self.n_labels + index))
+        counts = np.concatenate((self.overflow_counts, np.ones(voxels.shape[0], dtype=np.uint32)))
+        
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self.overflow_counts = np.bincount(inverse.ravel(), weights=counts).astype(np.uint32)
+        self.overflow_voxels = keys // self.n_labels
+        self.overflow_labels = keys % self.n_labels
+        
+    def gather_labels(self, labels, index):
+        """Return the vote counts of the given label indices at the given
+        voxels, two arrays which are broadcast together, without the counts
+        of the other labels. The label index n_labels marks an empty slot,
+        which gets no vote."""
+        
+        index = np.asarray(index)
+        votes = np.zeros(np.broadcast(labels, index).shape, dtype=self.counts.dtype)
+        for slot in range(self.max_labels): #the slots are gathered once for all the labels, the empty slots have no vote
+            votes += np.where(self.labels[slot, index] == labels, self.counts[slot, index], 0)
+            
+        if self.overflow_voxels.shape[0] > 0: #the overflow table is sorted by voxel and label
+            labels, index = np.broadcast_arrays(labels, index)
+            keys = self.overflow_voxels * self.n_labels + self.overflow_labels
+            query = index.astype(np.intp) * self.n_labels + labels
+            entries = np.minimum(np.searchsorted(keys, query), keys.shape[0] - 1)
+            found = (keys[entries] == query) & (labels < self.n_labels)
+            votes[found] += self.overflow_counts[entries[found]].astype(votes.dtype)
+            
+        return votes
+        
+    def candidates(self, index):
+        """Return the label indices and the vote counts of the labels which
+        receive votes at the given voxels, as two arrays of shape
+        (n_slots, number of voxels), where n_slots is the largest number of
+        such labels at one of the voxels. The labels of each voxel are in
+        increasing order, followed by empty slots with the label index
+        n_labels and no vote."""
+        
+        index = np.asarray(index)
+        slot_labels = self.labels[:, index]
+        slots, columns = np.nonzero(slot_labels != self.empty)
+        labels = slot_labels[slots, columns].astype(np.intp)
+        counts = self.counts[slots, index[columns]].astype(np.uint32)
+        
+        if self.overflow_voxels.shape[0] > 0: #add the overflow entries of each voxel
+            start = np.searchsorted(self.overflow_voxels, index, "left")
+            n_entries = np.searchsorted(self.overflow_voxels, index, "right") - start
+            entries = np.arange(np.sum(n_entries)) + np.repeat(start - np.cumsum(n_entries) + n_entries, n_entries)
+            columns = np.concatenate((columns, np.repeat(np.arange(index.shape[0]), n_entries)))
+            labels = np.concatenate((labels, self.overflow_labels[entries]))
+            counts = np.concatenate((counts, self.overflow_counts[entries]))
+            
+        order = np.lexsort((labels, columns))
+        return self.get_slots(columns[order], labels[order], counts[order], index.shape[0])
+        
+    def count_labels(self):
+        """Return the number of labels which receive at least one vote at
+        each voxel."""
+        
+        n_labels = np.sum(self.labels != self.empty, axis=0)
+        if self.overflow_voxels.shape[0] > 0:
+            n_labels += np.bincount(self.overflow_voxels, minlength=self.n_voxels)
+        return n_labels
+        
+    def max_votes(self):
+        """Return the largest vote count at each voxel."""
+        
+        max_votes = np.amax(self.counts, axis=0)
+        if self.overflow_voxels.shape[0] > 0:
+            np.maximum.at(max_votes, self.overflow_voxels, self.overflow_counts.astype(max_votes.dtype))
+        return max_votes
+        
+    def mode(self):
+        """Return the index of the majority vote label at each voxel. Ties
+        go to the smallest label index, as with the dense vote counts."""
+        
+        max_votes = self.max_votes()
+        mode = np.amin(np.where(self.counts == max_votes, self.labels, self.empty), axis=0)
+        
+        if self.overflow_voxels.shape[0] > 0:
+            top = self.overflow_counts == max_votes[self.overflow_voxels]
+            np.minimum.at(mode, self.overflow_voxels[top], self.overflow_labels[top].astype(mode.dtype))
+            
+        mode[mode == self.empty] = 0 #voxels without any vote
+        return mode.astype(np.intp)
+        
+    def top_two(self):
+        """Return the index of the majority vote label at each voxel, with
+        the largest and the second largest vote counts."""
+        
+        first = np.zeros(self.n_voxels, dtype=self.counts.dtype)
+        second = np.zeros(self.n_voxels, dtype=self.counts.dtype)
+        
+        for counts in self.counts: #keep the two largest counts over the slots
+            np.maximum(second, np.minimum(first, counts), out=second)
+            np.maximum(first, counts, out=first)
+            
+        if self.overflow_voxels.shape[0] > 0:
+            #go through the overflow entries by rank within each voxel, so the voxels are unique at each step
+            rank = np.arange(self.overflow_voxels.shape[0]) - np.searchsorted(self.overflow_voxels, self.overflow_voxels)
+            for r in range(np.amax(rank) + 1):
+                voxels = self.overflow_voxels[rank == r]
+                counts = self.overflow_counts[rank == r].astype(first.dtype)
+                second[voxels] = np.maximum(second[voxels], np.minimum(first[voxels], counts))
+                first[voxels] = np.maximum(first[voxels], counts)
+                
+        return self.mode(), first, second
+        
+
+def summed_area_table(x):
+    """Return the 3D cumulative sums of an array, with a leading row of zeros
+    along each axis so that box_sums can use the first index."""
+    
+    table = np.zeros(tuple(np.add(x.shape, 1)), dtype=np.result_type(x, np.float64))
+    np.cumsum(x, axis=0, out=table[1:, 1:, 1:])
+    np.cumsum(table[1:, 1:, 1:], axis=1, out=table[1:, 1:, 1:])
+    np.cumsum(table[1:, 1:, 1:], axis=2, out=table[1:, 1:, 1:])
+    return table
+    
+def box_sums(table, lo, hi):
+    """Return the sums over the boxes [lo, hi) from a summed-area table, with
+    lo and hi of shape (3, number of boxes)."""
+    
+    return (table[hi[0], hi[1], hi[2]] - table[lo[0], hi[1], hi[2]] - table[hi[0], lo[1], hi[2]] 
+            - table[hi[0], hi[1], lo[2]] + table[lo[0], lo[1], hi[2]] + table[lo[0], hi[1], lo[2]] 
+            + table[hi[0], lo[1], lo[2]] - table[lo[0], lo[1], lo[2]])
+            
+def window_min(x, radius):
+    """Return the minimum of a 3D array over the cube with edge length
+    (2*radius + 1) centered at each voxel. This is computed one axis at a
+    time, with windows of doubling length, so the cost only grows with the
+    logarithm of the radius."""
+    
+    width = 2*radius + 1
+    for axis in range(3):
+        y = np.moveaxis(x, axis, 0)
+        n = y.shape[0]
+        pad = np.zeros((radius,) + y.shape[1:], dtype=y.dtype) + np.inf
+        y = np.concatenate((pad, y, pad))
+        
+        length = 1
+        while 2*length <= width: #y[i] is the minimum over [i, i+length)
+            y = np.minimum(y[:-length], y[length:])
+            length *= 2
+            
+        x = np.moveaxis(np.minimum(y[:n], y[width-length:width-length+n]), 0, axis)
+    
+    return x
+
+class SharedArrays:
+    """Keep copies of numpy arrays in shared memory blocks, so that worker
+    processes can attach to them without copying. Each array is described
+    by a spec (block name, shape, dtype) which can be sent to the workers."""
+    
+    def __init__(self):
+        self.blocks = []
+        
+    def share(self, array):
+        """Copy an array to a new shared memory block and return its spec."""
+        
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return (block.name, array.shape, array.dtype.str)
+        
+    def empty(self, shape, dtype):
+        """Allocate an array in a new shared memory block and return the
+        array with its spec."""
+        
+        spec = self.share(np.zeros(shape, dtype=dtype))
+        return np.ndarray(shape, dtype=dtype, buffer=self.blocks[-1].buf), spec
+        
+    def close(self):
+        """Release all the shared memory blocks."""
+        
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        
+def attach_shared_array(spec, blocks):
+    """Return the array described by a spec from SharedArrays. The shared
+    memory block is appended to blocks, which must be kept as long as the
+    array is used."""
+    
+    name, shape, dtype = spec
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=name, track=False) #the parent process owns the block
+    else:
+        block = shared_memory.SharedMemory(name=name) #registered with the resource tracker of the parent
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    
+def init_mrf_worker(model_specs, counter_specs, counter_class, params):
+    """Initialize a worker process for PUB_MRF.run with several jobs. The
+    worker gets a PUB_MRF with only the attributes which are needed by
+    mrf_potentials_batch, with its arrays attached to shared memory. The
+    workers run their chunks in parallel already, so Numba uses a single
+    thread in each of them."""
+    
+    global mrf_worker
+    
+    limit_numba_threads()
+        
+    blocks = []
+    counter = counter_class.__new__(counter_class)
+    counter.__dict__.update(params.pop("counter"))
+    for name, spec in counter_specs.items():
+        setattr(counter, name, attach_shared_array(spec, blocks))
+    
+    mrf_worker = PUB_MRF.__new__(PUB_MRF)
+    mrf_worker.__dict__.update(params)
+    mrf_worker.counter = counter
+    mrf_worker.blocks = blocks
+    for name, spec in model_specs.items():
+        setattr(mrf_worker, name, attach_shared_array(spec, blocks))
+        
+def run_mrf_worker(chunk):
+    """Compute a chunk of low-confidence voxels in a worker process, and
+    write the posterior probabilities to the shared output arrays."""
+    
+    start, stop = chunk
+    probability, updated = mrf_worker.mrf_potentials_batch(start, stop)
+    mrf_worker.posterior[:, start:stop] = probability
+    mrf_worker.updated[start:stop] = updated
+    return stop - start
+
+def mrf_energy_kernel(votes, lcv, lcv_labels, offsets, weights, prob_lut, intensity, patch_mean, patch_std,
+                      probability, updated, singleton, doubleton, energy, potential_maps):
+    """Compute the MRF energies and the updated probabilities of a list of
+    low-confidence voxels from a dense vote array, with one loop iteration
+    per voxel, in the slots of the candidate labels of each voxel. The
+    singleton potential, the doubleton potential over the neighborhood and
+    the normalization of the probabilities are done together for each voxel,
+    without temporary arrays. This is compiled with Numba when it is
+    available. The posteriors are the ones of the NumPy code in
+    PUB_MRF.mrf_potentials_batch up to rounding, since the doubleton sum is a
+    loop here instead of np.dot, so the labels are the same except at exact
+    ties."""
+    
+    half = np.float32(0.5) #same precision as the NumPy code for the doubleton potentials
+    for j in prange(lcv.shape[0]):
+        v = lcv[j]
+        total = 0.0
+        for i in range(lcv_labels.shape[0]):
+            std = patch_std[i, j]
+            if np.isnan(std): #labels without patch stats and empty slots get an infinite energy
+                probability[i, j] = 0.0
+                if potential_maps:
+                    singleton[i, j] = -10.0
+                    doubleton[i, j] = -10.0
+                    energy[i, j] = -10.0
+                continue
+                
+            mrf_single = np.log(np.sqrt(2*np.pi)*std) + (intensity[v] - patch_mean[i, j])**2 / (2*std**2)
+            mrf_double = 0.0
+            for k in range(offsets.shape[0]):
+                mrf_double += (half - prob_lut[votes[lcv_labels[i, j], v + offsets[k]]]) * weights[k]
+                
+            mrf_energy = mrf_single + mrf_double
+            if potential_maps:
+                singleton[i, j] = mrf_single
+                doubleton[i, j] = mrf_double
+                energy[i, j] = mrf_energy
+                
+            probability[i, j] = np.exp(-mrf_energy)
+            total += probability[i, j]
+            
+        updated[j] = total > 0
+        if total > 0:
+            for i in range(lcv_labels.shape[0]):
+                probability[i, j] /= total
+                
+def get_compiled_kernel():
+    """Return mrf_energy_kernel compiled with Numba, or the plain function if
+    Numba is not installed. Numba is imported and the kernel is loaded from
+    its cache on the first call only, which takes a fraction of a second."""
+    
+    global compiled_kernel, prange
+    
+    if not numba_installed:
+        return mrf_energy_kernel
+    if compiled_kernel is None:
+        import numba
+        prange = numba.prange #the loop over the voxels is parallel in the compiled kernel
+        compiled_kernel = numba.njit(parallel=True, cache=True)(mrf_energy_kernel)
+    return compiled_kernel
+    
+def limit_numba_threads():
+    """Make the compiled kernel use a single thread in this process, for
+    worker processes which already run in parallel."""
+    
+    os.environ["NUMBA_NUM_THREADS"] = "1" #read when Numba is imported
+    if "numba" in sys.modules:
+        sys.modules["numba"].set_num_threads(1)
+
+class ArrayImage:
+    """A NumPy array in (z, y, x) order with the metadata of an image. It has
+    the same getters as a SimpleITK image for the metadata, so it can be used
+    instead of the brain image of PUB_MRF without converting the array."""
+    
+    def __init__(self, array, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), 
+                 direction=(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)):
+        self.array = array
+        self.spacing = tuple(float(x) for x in spacing)
+        self.origin = tuple(float(x) for x in origin)
+        self.direction = tuple(float(x) for x in direction)
+        
+    def GetSize(self):
+        return tuple(int(x) for x in self.array.shape[::-1])
+        
+    def GetSpacing(self):
+        return self.spacing
+        
+    def GetOrigin(self):
+        return self.origin
+        
+    def GetDirection(self):
+        return self.direction
+
+def get_image_array(img, bbox=None):
+    """Return the array of a SimpleITK image, an ArrayImage or a NumPy array
+    within a bounding box [xmin, ymin, zmin, xmax, ymax, zmax]. This is a
+    view on the image buffer, so the whole image is never copied, and the
+    image must be kept as long as the array is used."""
+    
+    if isinstance(img, ArrayImage):
+        array = img.array
+    elif isinstance(img, np.ndarray): #also for memory-mapped arrays
+        array = img
+    else:
+        array = sitk.GetArrayViewFromImage(img)
+        
+    if bbox is None:
+        return array
+    return array[bbox[2]:bbox[5], bbox[1]:bbox[4], bbox[0]:bbox[3]]
+    
+def read_image_array(filename, bbox=None):
+    """Read the array of an image file within a bounding box. Only this
+    region is extracted by the reader, which does not decode the other
+    voxels with the file formats that support it."""
+    
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    if bbox is not None:
+        reader.SetExtractIndex([int(x) for x in bbox[:3]])
+        reader.SetExtractSize([int(hi - lo) for lo, hi in zip(bbox[:3], bbox[3:])])
+    return sitk.GetArrayFromImage(reader.Execute())
+    
+def prefetch(function, items, depth):
+    """Yield function(item) for each item, in order, while up to depth calls
+    run ahead in a thread pool. SimpleITK releases the GIL while it decodes
+    an image, so the next images are decoded while the current one is used,
+    and at most depth results are kept waiting in memory."""
+    
+    if depth <= 1:
+        for item in items:
+            yield function(item)
+        return
+        
+    with ThreadPoolExecutor(depth) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    
+def read_image_information(filename):
+    """Return a reader with the metadata of an image file, without reading
+    the voxels."""
+    
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+    return reader
+    
+def get_bounding_box(label_array):
+    """Return the bounding box [xmin, ymin, zmin, xmax, ymax, zmax] of the
+    structural voxels of a label array, or None if there are none. The
+    projections along each axis are much cheaper than a shape analysis of
+    the thresholded image."""
+    
+    structure = label_array != 0
+    bbox = [0]*6
+    for axis in range(3): #array axis 0 is the z index
+        nonzero = np.where(structure.any(axis=tuple(a for a in range(3) if a != axis)))[0]
+        if nonzero.shape[0] == 0:
+            return None
+        bbox[2 - axis] = int(nonzero[0])
+        bbox[5 - axis] = int(nonzero[-1]) + 1
+    return bbox
+    
+def union_bounding_box(a, b):
+    """Return the smallest bounding box which contains the bounding boxes a
+    and b, where None is the empty bounding box."""
+    
+    if a is None or b is None:
+        return None if a is None and b is None else list(b if a is None else a)
+    return [min(a[i], b[i]) for i in range(3)] + [max(a[i], b[i]) for i in range(3, 6)]
+
+def file_key(filenames, *params):
+    """Return a sha1 key of files from their absolute paths, sizes and
+    modification times, with the given JSON parameters. The order of the
+    files matters."""
+    
+    files = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        files.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+    description = json.dumps([files] + list(params))
+    return hashlib.sha1(description.encode()).hexdigest()
+    
+class VoteCache:
+    """Keep the votes counted by PUB_MRF on disk, so that the runs on the same
+    candidate images with other MRF parameters can skip the ingestion. Each
+    entry is a directory of .npy files written by PUB_MRF.save_votes, which
+    are memory-mapped when they are loaded. The entries are keyed by the
+    paths, sizes and modification times of the input files, with the
+    parameters which change the ingestion. When the cache is larger than
+    max_bytes, the least recently used entries are removed."""
+    
+    version = 1 #change this when the format of the entries changes
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        
+    def get_key(self, filenames, patch_length, max_labels):
+        """Return the key of the votes from the given candidate files and brain
+        image file. The candidates are counted in order, so the order matters."""
+        
+        return file_key(filenames, self.version, patch_length, max_labels)
+        
+    def lookup(self, key):
+        """Return the directory of an entry, or None if it is not in the cache."""
+        
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path) #mark as recently used
+        return path
+        
+    def store(self, key, model):
+        """Save the votes of a PUB_MRF in a new entry, then remove the least
+        recently used entries if the cache is too large."""
+        
+        path = os.path.join(self.directory, key)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid()) #the entry only appears when it is complete
+        model.save_votes(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError: #already saved by another run
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+        
+    def evict(self, keep=None):
+        """Remove the least recently used entries, except keep, until the
+        cache is no larger than max_bytes."""
+        
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if ".tmp-" in key or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), key, size))
+            
+        total = sum(size for mtime, key, size in entries)
+        for mtime, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                total -= size
+                
+class VoteLibrary:
+    """Keep the candidate segmentations of a subject on disk, so that the
+    trials which fuse different subsets of the same candidates don't decode
+    the same files again. Each candidate is stored once, as the array of its
+    labels within the bounding box of its structures, and the brain image of
+    the subject is stored as a full array. All of them are .npy files which
+    are memory-mapped, and the votes of a trial are obtained by adding the
+    selected candidates within the bounding box of the trial. The entries
+    are keyed by the path, size and modification time of each file, and the
+    missing candidates are added when they are first needed."""
+    
+    def __init__(self, directory, brain_image):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.brain_key = self.add_entry(brain_image, crop=False)
+        
+    def get_key(self, filename):
+        """Return the key of the entry of a file."""
+        
+        return file_key([filename])
+        
+    def add_entry(self, filename, crop=True, img=None):
+        """Add a file to the library if it is not there yet, and return its
+        key. With crop, only the bounding box of the structures is kept."""
+        
+        key = self.get_key(filename)
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path + ".json"):
+            return key
+            
+        if img is None:
+            img = sitk.ReadImage(filename)
+        array = sitk.GetArrayViewFromImage(img)
+        bbox = get_bounding_box(array) if crop else [0, 0, 0] + list(img.GetSize())
+        if bbox is not None:
+            array = array[bbox[2]:bbox[5], bbox[1]:bbox[4], bbox[0]:bbox[3]]
+        else: #no structure, only the label type is needed
+            array = np.zeros((0, 0, 0), dtype=array.dtype)
+            
+        #the entry only appears when both files are complete
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        np.save(tmp_path + ".npy", array)
+        with open(tmp_path + ".json", "w") as f:
+            json.dump({"filename": os.path.abspath(filename), "bbox": bbox}, f)
+        os.replace(tmp_path + ".npy", path + ".npy")
+        os.replace(tmp_path + ".json", path + ".json")
+        return key
+        
+    def add(self, filenames, prefetch_depth=1):
+        """Add the candidate files which are not in the library yet. They are
+        decoded ahead in a thread pool like the other candidate images."""
+        
+        missing = [filename for filename in filenames 
+                   if not os.path.exists(os.path.join(self.directory, self.get_key(filename) + ".json"))]
+        for filename, img in zip(missing, prefetch(sitk.ReadImage, missing, prefetch_depth)):
+            self.add_entry(filename, img=img)
+            
+    def get_entry(self, filename):
+        """Return the bounding box and the memory-mapped array of a file."""
+        
+        path = os.path.join(self.directory, self.get_key(filename))
+        with open(path + ".json") as f:
+            bbox = json.load(f)["bbox"]
+        return bbox, np.load(path + ".npy", mmap_mode="r")
+        
+    def get_bounding_box(self, filenames):
+        """Return the bounding box of the structures of all the candidates,
+        or raise a ValueError if a candidate has no structure."""
+        
+        bbox = None
+        for filename in filenames:
+            new_bbox = self.get_entry(filename)[0]
+            if new_bbox is None:
+                raise ValueError("No structure found in {}".format(filename))
+            bbox = union_bounding_box(bbox, new_bbox)
+        return bbox
+        
+    def get_label_array(self, filename, bbox):
+        """Return the label array of a candidate within a bounding box which
+        contains the bounding box of its structures."""
+        
+        b, labels = self.get_entry(filename)
+        label_array = np.zeros((bbox[5] - bbox[2], bbox[4] - bbox[1], bbox[3] - bbox[0]), dtype=labels.dtype)
+        if b is not None:
+            label_array[b[2]-bbox[2]:b[5]-bbox[2], b[1]-bbox[1]:b[4]-bbox[1], b[0]-bbox[0]:b[3]-bbox[0]] = labels
+        return label_array
+        
+    def get_brain_array(self, bbox=None):
+        """Return the brain image array within a bounding box."""
+        
+        array = np.load(os.path.join(self.directory, self.brain_key + ".npy"), mmap_mode="r")
+        if bbox is None:
+            return array
+        return array[bbox[2]:bbox[5], bbox[1]:bbox[4], bbox[0]:bbox[3]]
+                
+def copy_information(img, reference):
+    """Copy the origin, the spacing and the direction of a reference image,
+    which can also be an ImageFileReader with the image information."""
+    
+    img.SetOrigin(reference.GetOrigin())
+    img.SetSpacing(reference.GetSpacing())
+    img.SetDirection(reference.GetDirection())
+
+def get_offsets(shape, radius):
+    """Return the flat index offsets of the voxels in a cube with edge length
+    (2*radius + 1) centered at a voxel, for an array of the given shape. The
+    offsets are in C order, and the center of the cube is the middle one."""
+    
+    r = np.arange(-radius, radius + 1)
+    i, j, k = np.meshgrid(r, r, r, indexing="ij")
+    return ((i*shape[1] + j)*shape[2] + k).ravel()
+    
+
+class Profiler:
+    """Record the wall time, the CPU time and the growth of the peak resident
+    memory of each stage of a fusion job, with some item counts. The report
+    is a JSON document with this schema:
+    
+        {"schema": "pub_mrf.profile/1",
+         "command": [command line arguments],
+         "total": {"wall_seconds", "cpu_seconds", "peak_rss_mb"},
+         "stages": [{"name", "parent", "wall_seconds", "cpu_seconds",
+                     "peak_rss_delta_mb", "peak_rss_mb"}, ...],
+         "counts": {"candidates", "labels", "bbox_voxels", "lcv", ...}}
+    
+    The stages are listed in the order in which they end. A stage which runs
+    within another one has its name as parent, and its time is included in
+    the time of the parent. The CPU time is the time of this process, without
+    the worker processes. A disabled profiler records nothing."""
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.counts = {}
+        self.running = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        
+    def get_peak_rss(self):
+        """Return the peak resident memory of the process in MB, or None."""
+        
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2.0**20 if sys.platform == "darwin" else peak / 2.0**10 #bytes on macOS, kB on Linux
+        
+    @contextmanager
+    def stage(self, name):
+        """Record the stage which runs within this context."""
+        
+        if not self.enabled:
+            yield
+            return
+        
+        parent = self.running[-1] if self.running else None
+        self.running.append(name)
+        peak_rss = self.get_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.running.pop()
+            record = {"name": name, "parent": parent, "wall_seconds": time.perf_counter() - wall,
+                      "cpu_seconds": time.process_time() - cpu, "peak_rss_delta_mb": None, "peak_rss_mb": None}
+            if peak_rss is not None:
+                record["peak_rss_mb"] = self.get_peak_rss()
+                record["peak_rss_delta_mb"] = record["peak_rss_mb"] - peak_rss
+            self.stages.append(record)
+            
+    def count(self, name, value):
+        """Record an item count."""
+        
+        if self.enabled:
+            self.counts[name] = int(value)
+            
+    def get_report(self, command=None):
+        """Return the report as a dict."""
+        
+        return {"schema": "pub_mrf.profile/1", "command": command,
+                "total": {"wall_seconds": time.perf_counter() - self.start_wall,
+                          "cpu_seconds": time.process_time() - self.start_cpu, "peak_rss_mb": self.get_peak_rss()},
+                "stages": self.stages, "counts": self.counts}
+                
+    def save(self, filename, command=None):
+        """Write the report to a JSON file."""
+        
+        with open(filename, "w") as f:
+            json.dump(self.get_report(command), f, indent=1)
+            
+def fuse(candidates, intensity, spacing=(1.0, 1.0, 1.0), crop=True, **params):
+    """Fuse candidate segmentations with PUB-MRF without any file or image
+    conversion, and return (labels, posteriors).
+    
+    candidates : NumPy arrays (memory-mapped arrays work too), SimpleITK
+                 images or file names of the candidate segmentations, with
+                 the same (z, y, x) shape as the intensities. The file names
+                 are read one at a time.
+    intensity  : the brain intensities as a NumPy array in (z, y, x) order.
+    spacing    : the voxel spacing in (x, y, z) order, used with use_spacing.
+    crop       : restrict the computations to the bounding box of the
+                 structures, padded with the patch length, like the command
+                 line program does.
+    params     : the other parameters of PUB_MRF, like alpha, beta,
+                 patch_length or threshold. With jobs > 1, the worker
+                 processes import the main module, so a script must call
+                 fuse under if __name__ == "__main__".
+    
+    labels is an array of label values with the shape of the intensities.
+    posteriors is a dict with the label values, the (3, n_lcv) coordinates
+    of the low-confidence voxels, and their (n_labels, n_lcv) posterior
+    probabilities, which are 0 for the labels without votes at a voxel. The
+    other voxels keep the majority vote."""
+    
+    brainimg = ArrayImage(np.asarray(intensity), spacing)
+    
+    bbox = None
+    if crop: #union of the bounding boxes of the structures
+        if not isinstance(candidates, (list, tuple)):
+            candidates = list(candidates)
+        for img in candidates:
+            label_array = read_image_array(img) if isinstance(img, str) else get_image_array(img)
+            bbox = union_bounding_box(bbox, get_bounding_box(label_array))
+        if bbox is not None:
+            bbox = np.asarray(bbox)
+            
+    model = PUB_MRF(candidates, brainimg, bbox=bbox, **params)
+    model.compute_posteriors()
+    labels = model.get_label_array(model.get_output_array())
+    
+    posteriors = {"label_values": model.label_values, "coordinates": model.get_lcv_coordinates(),
+                  "probability": model.get_label_rows(model.lcv_probability)}
+    return labels, posteriors
+
 class PUB_MRF:
     """The PUB-MRF algorithm uses a Markov Random Field model to update the
     label probabilities obtained with a multi-atlas registration method. In
@@ -55,7 +1015,37 @@ class PUB_MRF:
     self.beta          : The weights in the 26-voxel neighborhood for the
                          doubleton potential are evaluated with an expotential
                          decay function with parameter self.beta, with respect
-                         to the Euclidian norm.
+                         to the Euclidian norm. If self.use_spacing is set,
+                         the distances take the voxel spacing of the brain
+                         image into account, in units of the smallest spacing.
+    
+    self.max_labels    : If given, the votes are kept in a sparse
+                         representation with at most max_labels candidate
+                         labels per voxel, plus an overflow table. This is
+                         useful for atlases with many structures.
+    
+    self.engine        : With "batch", the MRF energies of the low-confidence
+                         voxels are computed with array operations, chunk_size
+                         voxels at a time. With "voxel", they are computed
+                         one voxel at a time. With self.jobs > 1, the chunks
+                         of the batch engine are shared between processes.
+                         These are new processes which import the main
+                         module, so a script which uses several jobs must
+                         create PUB_MRF under if __name__ == "__main__".
+    
+    self.backend       : With "numba", the batch engine uses a compiled
+                         kernel with one parallel loop over the low-confidence
+                         voxels. This needs Numba and dense votes. With
+                         "auto", it is used if possible and if there are at
+                         least min_compiled_lcv low-confidence voxels, since
+                         importing Numba and loading the kernel costs more
+                         than the NumPy code for fewer voxels. Otherwise NumPy
+                         is used.
+    
+    self.potential_maps_format : With "images", run builds a full size image
+                         for each potential map and label. With "npz", the
+                         maps are only kept at the low-confidence voxels,
+                         and they can be saved with save_potential_maps.
     
     Key features of this version:
     - Works with any number of separate or adjacent labels
@@ -66,12 +1056,27 @@ class PUB_MRF:
     (C) Charles Lagace, Nikhil Bhagwat, Chakravarty Lab
     http://www.douglas.qc.ca/researcher/mallar-chakravarty?locale=en"""
     
+    min_compiled_lcv = 500000 #fewest low-confidence voxels for which the auto backend loads the compiled kernel
+    
     def __init__(self, labelimg_list, brainimg, bbox=None, alpha=2.0, beta=2.7, 
-                 patch_length=5, threshold=0.2, verbose=False, potential_maps=False):
+                 patch_length=5, threshold=0.2, verbose=False, potential_maps=False, max_labels=None,
+                 engine="batch", chunk_size=4096, use_spacing=False, jobs=1, backend="auto",
+                 potential_maps_format="images", prefetch_depth=1, cached=None, library=None, profiler=None):
         """Count the votes from a list of SimpleITK image, and compute the
         prior probabilities. If this program is run from the terminal, a
         bounding box is automatically use to restrict this computation to the
-        relevant region."""
+        relevant region. The list can also be any iterable of images, of
+        NumPy arrays in (z, y, x) order, or of file names, which are then
+        read one at a time while the votes are counted, so that a single
+        candidate image is kept in memory. The brain image can be an
+        ArrayImage to use a NumPy array of intensities.
+        
+        If cached is the directory of votes saved by save_votes, the votes,
+        the bounding box and the intensities are loaded from it instead, and
+        brainimg is only used for its metadata. If library is a VoteLibrary,
+        the file names in the list and the brain image are read from it, so
+        brainimg is also only used for its metadata. The stages are recorded
+        by the profiler if one is given."""
                 
         def positive_int(x): #avoid nonsense negative parameter values   
             x = int(x)
@@ -79,6 +1084,12 @@ class PUB_MRF:
                 raise AssertionError("%r is not a positive int"%(x,))
             return x
             
+        def strictly_positive_int(x): #for counts which can't be zero
+            x = int(x)
+            if x < 1:
+                raise AssertionError("%r is not a strictly positive int"%(x,))
+            return x
+            
         def restricted_float(x): #avoid nonsense values for the threshold
             x = float(x)
             if x < 0.0 or x > 1.0:
@@ -92,147 +1103,426 @@ class PUB_MRF:
         self.threshold = restricted_float(threshold)
         self.verbose = bool(verbose)
         self.potential_maps = bool(potential_maps)
+        self.max_labels = None if max_labels is None else strictly_positive_int(max_labels)
+        self.chunk_size = max(positive_int(chunk_size), 1)
+        self.use_spacing = bool(use_spacing)
+        self.jobs = max(positive_int(jobs), 1)
+        self.prefetch_depth = positive_int(prefetch_depth)
+        self.profiler = Profiler(enabled=False) if profiler is None else profiler
+        
+        if engine not in ("batch", "voxel"):
+            raise AssertionError("%r is not a valid engine"%(engine,))
+        self.engine = engine
+        
+        if potential_maps_format not in ("images", "npz"):
+            raise AssertionError("%r is not a valid potential maps format"%(potential_maps_format,))
+        self.potential_maps_format = potential_maps_format
+        
+        if backend not in ("auto", "numpy", "numba"):
+            raise AssertionError("%r is not a valid backend"%(backend,))
+        if backend == "numba" and not numba_installed:
+            warn("Numba is not installed, using the NumPy backend.")
+        if backend == "numba" and max_labels is not None:
+            warn("The Numba backend needs dense votes, using the NumPy backend.")
+        #with auto, the backend is chosen from the number of low-confidence voxels by compute_posteriors
+        self.backend = backend if backend != "numpy" and numba_installed and max_labels is None else "numpy"
 
-        if bbox is not None:        
-            bbox[:3] -= self.patch_length #pad the bounding box with the patch length
-            bbox[3:] += self.patch_length
+        if cached is None:
+            with self.profiler.stage("count_votes"):
+                self.count_votes(labelimg_list, brainimg, bbox, library)
+        else: #skip the ingestion
+            with self.profiler.stage("load_votes"):
+                self.load_votes(cached)
             
-        if opt.verbose:
+        self.brainimg = brainimg #keep this to copy the metadata to the output image
+        
+        self.profiler.count("candidates", self.n_candidates)
+        self.profiler.count("labels", self.label_values.shape[0])
+        self.profiler.count("bbox_voxels", self.counter.n_voxels)
+        
+        if self.verbose:
+            print("Computing prior probabilities...")        
+        
+        #the prior probabilities are obtained from the vote counts with a lookup table
+        self.prob_lut = np.arange(self.n_candidates + 1, dtype=np.float32) / self.n_candidates
+        
+    def count_votes(self, labelimg_list, brainimg, bbox, library=None):
+        """Count the votes from the candidate images within the bounding box,
+        padded with the patch length, and get the intensities of the brain
+        image within the same bounding box."""
+        
+        if bbox is not None: #pad the bounding box with the patch length, inside of the image
+            bbox[:3] = np.maximum(bbox[:3] - self.patch_length, 0)
+            bbox[3:] = np.minimum(bbox[3:] + self.patch_length, brainimg.GetSize())
+            
+        if self.verbose:
             print("Counting votes from images...")
                        
-        for n, img in enumerate(labelimg_list):
-            if bbox is None:
-                label_array = sitk.GetArrayFromImage(img) #get the label array from each image
-            else: #get each array within the bounding box
-                label_array = sitk.GetArrayFromImage(img)[bbox[2]:bbox[5], bbox[1]:bbox[4], bbox[0]:bbox[3]]
-                
+        def load_label_array(img):
+            if isinstance(img, str) and library is not None: #the candidate was decoded by an earlier run
+                return library.get_label_array(img, bbox)
+            if isinstance(img, str): #streaming mode, read the candidate image from its file
+                return read_image_array(img, bbox)
+            return get_image_array(img, bbox) #get the label array from each image, within the bounding box
+            
+        self.n_candidates = 0
+        for n, label_array in enumerate(prefetch(load_label_array, labelimg_list, self.prefetch_depth)):
             if n == 0:
                 self.label_values = np.unique(label_array) #obtain the list of labels
                 self.label_shape = label_array.shape
-                votes = np.zeros((self.label_values.shape[0], label_array.ravel().shape[0]), dtype=np.float32)
+                if self.max_labels is None:
+                    counter = VoteCounter(self.label_values, label_array.size)
+                else: #sparse vote counts for large label sets
+                    counter = SparseVoteCounter(self.label_values, label_array.size, self.max_labels)
                 
                 if self.verbose:
                     print("PUB-MRF found {} labels, including background.".format(self.label_values.shape[0]))
             
-            elif np.asarray(np.unique(label_array) != self.label_values).any(): #check label equivalence
-                warn("Labels in image {} not the same as in image 1.".format(n))
+            label_counts = counter.add(label_array) #count the votes for each label
             
-            for i, value in enumerate(self.label_values):
-                votes[i][np.where(label_array.ravel() == value)] += 1 #count the votes for each label
+            if (label_counts[:-1] == 0).any() or label_counts[-1] > 0: #check label equivalence
+                warn("Labels in image {} not the same as in image 1.".format(n))
+                
+            self.n_candidates += 1
+            del label_array #release the candidate image before reading the next one
         
-        if bbox is None:
-            self.intensity = sitk.GetArrayFromImage(brainimg).ravel() #array of intensities
+        self.counter = counter #integer vote counts
+        
+        if library is None:
+            self.intensity = np.array(get_image_array(brainimg, bbox)).ravel() #array of intensities
         else:
-            self.intensity = sitk.GetArrayFromImage(brainimg)[bbox[2]:bbox[5],bbox[1]:bbox[4],bbox[0]:bbox[3]].ravel()
+            self.intensity = np.array(library.get_brain_array(bbox)).ravel()
             
         self.bbox = bbox #keep the bounding box for the final fusion labels
-        self.brainimg = brainimg #keep this to copy the metadata to the output image
         
-        if self.verbose:
-            print("Computing prior probabilities...")        
+    def save_votes(self, directory):
+        """Save the vote counts, the label values, the bounding box and the
+        intensities in a directory of .npy files, which can be loaded with
+        the cached parameter."""
+        
+        os.makedirs(directory)
+        meta = {"label_shape": list(self.label_shape), "n_candidates": self.n_candidates, 
+                "counter_class": type(self.counter).__name__, "counter": {}, "bbox": None}
+        
+        for name, value in self.counter.__dict__.items():
+            if name in ("voxels", "lut"): #rebuilt when loading
+                continue
+            elif isinstance(value, np.ndarray):
+                np.save(os.path.join(directory, "counter." + name + ".npy"), value)
+            else:
+                meta["counter"][name] = int(value)
+                
+        if self.bbox is not None:
+            meta["bbox"] = [int(x) for x in self.bbox]
+        np.save(os.path.join(directory, "intensity.npy"), self.intensity)
+        
+        with open(os.path.join(directory, "votes.json"), "w") as f:
+            json.dump(meta, f)
+            
+    def load_votes(self, directory):
+        """Load the votes saved by save_votes. The arrays are memory-mapped,
+        so only the pages which are used are read from the disk."""
         
-        self.probability = np.array(votes / len(labelimg_list), dtype=np.float32) #get the initial probabilities
-        self.new_probability = np.copy(self.probability)
+        with open(os.path.join(directory, "votes.json")) as f:
+            meta = json.load(f)
+            
+        counter_class = {"VoteCounter": VoteCounter, "SparseVoteCounter": SparseVoteCounter}[meta["counter_class"]]
+        counter = counter_class.__new__(counter_class)
+        counter.__dict__.update(meta["counter"])
+        for filename in os.listdir(directory):
+            if filename.startswith("counter."):
+                setattr(counter, filename.split(".")[1], np.load(os.path.join(directory, filename), mmap_mode="r"))
+        counter.voxels = np.arange(counter.n_voxels)
+        counter.lut = {}
+        
+        self.counter = counter
+        self.label_values = np.array(counter.label_values)
+        self.label_shape = tuple(meta["label_shape"])
+        self.n_candidates = meta["n_candidates"]
+        self.bbox = None if meta["bbox"] is None else np.array(meta["bbox"])
+        self.intensity = np.load(os.path.join(directory, "intensity.npy"), mmap_mode="r")
+        
+        if self.verbose:
+            print("Loaded the votes of {} images from {}".format(self.n_candidates, directory))
             
     def run(self):
         """This will initialize the list of low-confidence voxels, update the
         probabilities at these voxels, and return the final segmentation as a
         SimpleITK image."""
+        
+        self.compute_posteriors()
+        
+        return self.get_output_image()
+        
+    def compute_posteriors(self):
+        """Initialize the list of low-confidence voxels and compute their
+        posterior probabilities in self.lcv_probability."""
              
-        self.find_lcv()
+        with self.profiler.stage("find_lcv"):
+            self.find_lcv()
+        self.profiler.count("lcv", self.lcv.shape[0])
+        
+        if self.backend == "auto":
+            self.backend = "numba" if self.lcv.shape[0] >= self.min_compiled_lcv else "numpy"
         
         if self.verbose:
             print("Computing posterior probabilities with MRF model...")
         
-        self.lcv_index = 0        
-        while self.lcv_index < self.lcv.shape[0]:
-            self.get_patch_stats()
-            self.mrf_potentials()
-            self.lcv_index += 1
+        with self.profiler.stage("mrf_potentials"):
+            if self.engine == "batch": #the result does not depend on the updating sequence
+                chunks = [(start, min(start + self.chunk_size, self.lcv.shape[0])) 
+                          for start in range(0, self.lcv.shape[0], self.chunk_size)]
+                self.profiler.count("chunks", len(chunks))
+                          
+                if self.jobs > 1 and len(chunks) > 1:
+                    self.mrf_potentials_parallel(chunks)
+                else:
+                    for start, stop in chunks:
+                        self.update_probability(start, *self.mrf_potentials_batch(start, stop))
+                    
+            else:
+                self.lcv_index = 0        
+                while self.lcv_index < self.lcv.shape[0]:
+                    self.get_patch_stats()
+                    self.mrf_potentials()
+                    self.lcv_index += 1
     
-        if self.potential_maps:
-            self.get_potential_maps()
-        
-        return self.get_output_image()
+        if self.potential_maps and self.potential_maps_format == "images":
+            with self.profiler.stage("potential_maps"):
+                self.get_potential_maps() #the npz format is written from the arrays by save_potential_maps
         
     def find_lcv(self):
         """Initialize the list of low-confidence voxels. Also initialize the
-        neighborhoods and the patches of each low-confidence voxel. The patch
-        region is used for the singleton potentials, and the neighborhood
-        region is used for the doubleton potentials."""    
+        flat index offsets of the neighborhood, which is used for the
+        doubleton potentials, and the patch stats of every low-confidence
+        voxel, which are used for the singleton potentials.
+        
+        The arrays of the low-confidence voxels, like the probabilities and
+        the patch stats, have a slot for each candidate label of a voxel,
+        with the label indices in self.lcv_labels, so their size depends on
+        the largest number of candidate labels rather than on the number of
+        labels. The empty slots have the label index n_labels."""    
         
         if self.verbose:
             print("Initializing the list of low-confidence voxels...")
         
+        #the neighborhood of a voxel is obtained by adding these offsets to its index
+        self.neighbor_offsets = get_offsets(self.label_shape, 1) #26-voxel neighborhood
+        self.neighbor_weights = self.get_neighbor_weights()
+        
         #find the low-confidence voxels using dynamic thresholds
-        n_labels = np.sum(self.probability > 0, axis=0)
-        self.lcv = np.where((n_labels > 1) & (np.amax(self.probability, axis=0) < 1.0/n_labels + self.threshold))[0]
+        n_labels = self.counter.count_labels()
+        max_probability = self.prob_lut[self.counter.max_votes()]
+        self.lcv = np.where((n_labels > 1) & (max_probability < 1.0/n_labels + self.threshold))[0]
         
         if self.lcv.shape[0] == 0: #in this case we just want to return the majority vote
             self.no_lcv = True
+            self.lcv_labels = np.zeros((0, 0), dtype=np.intp)
+            self.lcv_probability = np.zeros((0, 0), dtype=np.float32)
             warn("No low-confidence voxel was found.")
             
         else:
             self.no_lcv = False
-                
-            self.neighbors = {}
-            self.patches = {}
-            self.candidate_labels = {}
             
-            for lcv in self.lcv: #find the neighborhood of each lcv
-                x, y, z = np.unravel_index(lcv, self.label_shape) #get coordinates of voxels
-                
-                neighbors = []                
-                for i in range(x-1, x+2):
-                    for j in range(y-1, y+2):
-                        for k in range(z-1, z+2):
-                            neighbors.append(np.ravel_multi_index((i,j,k), self.label_shape))
-                self.neighbors[lcv] = neighbors #26-voxel neighborhood
-                
-                patch = []                
-                for i in range(x-self.patch_length, x+self.patch_length+1):
-                    for j in range(y-self.patch_length, y+self.patch_length+1):
-                        for k in range(z-self.patch_length, z+self.patch_length+1):
-                            patch.append(np.ravel_multi_index((i,j,k), self.label_shape))
-                self.patches[lcv] = patch #patch neighborhood
-                
-                #get the candidate labels for each low-confidence voxel
-                self.candidate_labels[lcv] = self.label_values[self.probability[:, lcv].nonzero()]
+            #the flat offsets would wrap around the edges, so the patches must stay inside the bounding box
+            radius = max(self.patch_length, 1)
+            coord = np.array(np.unravel_index(self.lcv, self.label_shape))
+            if (coord < radius).any() or (coord >= np.array(self.label_shape)[:, None] - radius).any():
+                raise ValueError("The patch of a low-confidence voxel is not inside of the image.")
+            
+            #posterior probabilities of the low-confidence voxels only, the others keep the majority vote,
+            #in one slot for each candidate label of a voxel instead of a row for each label
+            self.lcv_labels, lcv_votes = self.counter.candidates(self.lcv)
+            self.lcv_probability = self.prob_lut[lcv_votes]
                 
         if self.verbose:
             print("PUB-MRF found {} low-confidence voxels.".format(self.lcv.shape[0]))
+            
+        if not self.no_lcv:
+            with self.profiler.stage("patch_stats"):
+                self.init_patch_stats()
         
         #prepare the arrays that will keep the potential maps for all the low-confidence voxels
-        if self.potential_maps:
-            self.singleton = np.zeros((self.label_values.shape[0], self.lcv.shape[0]), dtype=np.float32) - 10.0
-            self.prior = np.zeros((self.label_values.shape[0], self.lcv.shape[0]), dtype=np.float32) - 10.0
-            self.doubleton = np.zeros((self.label_values.shape[0], self.lcv.shape[0]), dtype=np.float32) - 10.0
-            self.energy = np.zeros((self.label_values.shape[0], self.lcv.shape[0]), dtype=np.float32) - 10.0
+        if self.potential_maps: #in the slots of the candidate labels
+            self.singleton = np.zeros(self.lcv_labels.shape, dtype=np.float32) - 10.0
+            self.prior = np.zeros(self.lcv_labels.shape, dtype=np.float32) - 10.0
+            self.doubleton = np.zeros(self.lcv_labels.shape, dtype=np.float32) - 10.0
+            self.energy = np.zeros(self.lcv_labels.shape, dtype=np.float32) - 10.0
                 
+    def get_neighbor_weights(self):
+        """Return the weights of the doubleton potential for the voxels of the
+        26-voxel neighborhood, in the same order as the neighbor offsets. The
+        weights only depend on the distance to the center voxel, so they are
+        the same for every low-confidence voxel."""
+        
+        return self.alpha*np.exp(-self.beta*self.get_neighbor_distances())
+        
+    def get_neighbor_distances(self):
+        """Return the distances to the center voxel of the voxels of the
+        26-voxel neighborhood, in the same order as the neighbor offsets."""
+        
+        offsets = np.indices((3,3,3)).reshape(3, -1) - 1
+        
+        if self.use_spacing: #physical distances, relative to the smallest voxel spacing
+            spacing = np.asarray(self.brainimg.GetSpacing()[::-1], dtype=np.float64) #array axes are in reverse order
+            offsets = offsets * (spacing / np.amin(spacing))[:, None]
+            
+        return np.linalg.norm(offsets, axis=0)
+        
+    def init_energy_cache(self, max_threshold=1.0):
+        """Compute the parts of the MRF energies which don't depend on alpha,
+        beta and the threshold, for the low-confidence voxels found with
+        max_threshold. These voxels include the low-confidence voxels of
+        every smaller threshold. The singleton potentials only depend on the
+        patch stats, and the doubleton potential is
+        
+            alpha * sum over the shells of exp(-beta * d) * S
+            
+        where the shells are the sets of neighbors at the same distance d of
+        the center voxel (4 shells without use_spacing), and S is the sum of
+        (0.5 - prior probability) over the neighbors of a shell. Then fuse_from_cache
+        gives the segmentation for any alpha, beta and threshold without
+        computing the patch stats again."""
+        
+        threshold = self.threshold
+        self.threshold = max_threshold
+        try:
+            self.find_lcv()
+        finally:
+            self.threshold = threshold
+        self.max_threshold = max_threshold
+        
+        if self.verbose:
+            print("Computing the energy cache...")
+        
+        if self.no_lcv: #there are no patch stats
+            self.patch_mean = self.patch_std = np.zeros((0, 0))
+        
+        n_labels = self.counter.count_labels()[self.lcv]
+        self.cache_lcv = self.lcv
+        self.cache_n_labels = n_labels
+        self.cache_max_probability = self.prob_lut[self.counter.max_votes()[self.lcv]]
+        self.cache_labels = self.lcv_labels
+        self.cache_prior = self.lcv_probability
+        
+        #group the neighbors in shells of equal distance
+        self.shell_distances, shells = np.unique(self.get_neighbor_distances(), return_inverse=True)
+        shell_matrix = np.zeros((shells.shape[0], self.shell_distances.shape[0]))
+        shell_matrix[np.arange(shells.shape[0]), shells] = 1.0
+        
+        self.cache_singleton = np.zeros(self.lcv_labels.shape) + np.nan
+        self.cache_shells = np.zeros(self.lcv_labels.shape + self.shell_distances.shape)
+        for start in range(0, self.lcv.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, self.lcv.shape[0])
+            lcv = self.lcv[start:stop]
+            
+            mean = self.patch_mean[:, start:stop]
+            std = self.patch_std[:, start:stop]
+            self.cache_singleton[:, start:stop] = (np.log(np.sqrt(2*np.pi)*std) + 
+                                                   np.power(self.intensity[lcv]-mean,2)/(2*np.power(std,2)))
+            
+            neighbor_votes = self.counter.gather_labels(self.lcv_labels[:, start:stop, None], lcv[:, None] + self.neighbor_offsets)
+            self.cache_shells[:, start:stop] = np.dot(0.5 - self.prob_lut[neighbor_votes], shell_matrix)
+            
+        del self.patch_mean, self.patch_std #only the cached energies are needed now
+            
+    def fuse_from_cache(self, alpha, beta, threshold):
+        """Return the final segmentation for the given parameters from the
+        energy cache, as a SimpleITK image. This is the same as run with
+        these parameters, up to the rounding of the doubleton sums."""
+        
+        if threshold > self.max_threshold:
+            raise AssertionError("%r is larger than the threshold of the energy cache"%(threshold,))
+        self.alpha, self.beta, self.threshold = float(alpha), float(beta), float(threshold)
+        
+        mask = self.cache_max_probability < 1.0/self.cache_n_labels + self.threshold
+        self.lcv = self.cache_lcv[mask]
+        self.lcv_labels = self.cache_labels[:, mask]
+        self.no_lcv = self.lcv.shape[0] == 0
+        
+        mrf_single = self.cache_singleton[:, mask]
+        mrf_double = np.dot(self.cache_shells[:, mask], self.alpha*np.exp(-self.beta*self.shell_distances))
+        mrf_energy = np.where(np.isnan(mrf_single), np.inf, mrf_single + mrf_double)
+        
+        probability = np.exp(-mrf_energy)
+        total = np.sum(probability, axis=0)
+        updated = total > 0
+        self.lcv_probability = self.cache_prior[:, mask]
+        self.lcv_probability[:, updated] = probability[:, updated] / total[updated]
+        
+        return self.get_output_image()
+        
+    def init_patch_stats(self):
+        """Compute the weighted patch stats of all the low-confidence voxels
+        at once. In the patch of a voxel v, a voxel u has a weight for label l
+        if l has the most votes at u, and this weight is the difference
+        between the two largest probabilities at u. The sums of the weights,
+        of the weighted intensities and of their squares over any patch are
+        obtained from summed-area tables, which are built for each label over
+        the region covered by the patches where it is a candidate label.
+        
+        A standard deviation of 0 would not be detected reliably from these
+        sums, so it is found from the minimum and the maximum of the weighted
+        intensities over each patch instead."""
+        
+        p = self.patch_length
+        shape = np.array(self.label_shape)
+        coord = np.array(np.unravel_index(self.lcv, self.label_shape))
+        
+        mode, first, second = self.counter.top_two()
+        margin = (self.prob_lut[first] - self.prob_lut[second]).reshape(self.label_shape)
+        mode = mode.reshape(self.label_shape)
+        del first, second
+        
+        #center the intensities to reduce the rounding errors in the sums of squares
+        offset = np.mean(self.intensity, dtype=np.float64)
+        intensity = self.intensity.reshape(self.label_shape)
+        
+        self.patch_mean = np.zeros(self.lcv_labels.shape) + np.nan
+        self.patch_std = np.zeros(self.lcv_labels.shape) + np.nan
+        
+        #the slots of each label, grouped by label index
+        slots = np.argsort(self.lcv_labels.ravel(), kind="stable")
+        bounds = np.searchsorted(self.lcv_labels.ravel()[slots], np.arange(self.label_values.shape[0] + 1))
+        
+        for i in range(self.label_values.shape[0]):
+            if bounds[i] == bounds[i + 1]: #not a candidate label of any voxel
+                continue
+            slot, index = np.divmod(slots[bounds[i]:bounds[i + 1]], self.lcv.shape[0])
+            c = coord[:, index]
+            lo = np.maximum(np.amin(c, axis=1) - p, 0) #region covered by the patches
+            hi = np.minimum(np.amax(c, axis=1) + p + 1, shape)
+            region = (slice(lo[0], hi[0]), slice(lo[1], hi[1]), slice(lo[2], hi[2]))
+            
+            weight = np.where(mode[region] == i, margin[region], 0.0)
+            values = intensity[region] - offset
+            n_weights = box_sums(summed_area_table(weight > 0), c - lo[:, None] - p, c - lo[:, None] + p + 1)
+            sum_weights = box_sums(summed_area_table(weight), c - lo[:, None] - p, c - lo[:, None] + p + 1)
+            sum_values = box_sums(summed_area_table(weight*values), c - lo[:, None] - p, c - lo[:, None] + p + 1)
+            sum_squares = box_sums(summed_area_table(weight*values*values), c - lo[:, None] - p, c - lo[:, None] + p + 1)
+            
+            #extreme values of the weighted intensities
+            local = tuple(c - lo[:, None])
+            min_values = window_min(np.where(weight > 0, values, np.inf), p)[local]
+            max_values = -window_min(np.where(weight > 0, -values, np.inf), p)[local]
+            
+            valid = (n_weights > 0) & (max_values > min_values) #a standard deviation of 0 doesn't make sense
+            mean = sum_values[valid] / sum_weights[valid]
+            variance = np.maximum(sum_squares[valid] / sum_weights[valid] - mean*mean, 0.0)
+            
+            self.patch_mean[slot[valid], index[valid]] = mean + offset
+            self.patch_std[slot[valid], index[valid]] = np.sqrt(variance)
+    
     def get_patch_stats(self):
-        """Compute the patch stats for the current low-confidence voxel using
-        the mean and the standard deviation. These stats are used to compute
-        the MRF singleton potentials."""
+        """Get the patch stats for the current low-confidence voxel, using
+        the weighted mean and standard deviation computed by init_patch_stats.
+        These stats are used to compute the MRF singleton potentials."""
                 
         self.patch_stats = {}
-        patch = np.asarray(self.patches[self.lcv[self.lcv_index]])
-        probability = self.probability[:, patch]
-        sorted_prob = np.sort(probability, axis=0)[::-1] #sort in descending order
-            
-        #get the patch stats for each candidate label
-        for value in self.candidate_labels[self.lcv[self.lcv_index]]:
-            intensity = self.intensity[patch]
-            value_index = np.where(self.label_values == value)
-            weight = np.equal(probability[value_index], sorted_prob[0]) * (sorted_prob[0] - sorted_prob[1])
-            
-            if np.sum(weight) > 0.0:
-                mean = np.sum(intensity * weight) / np.sum(weight) #weighted mean
-                std = np.sqrt(np.sum(np.power(intensity-mean,2)*weight)/np.sum(weight)) #weighted std
-                
-                if std != 0.0: #a standard deviation of 0 doesn't make sense for the singleton computation
-                    self.patch_stats[value] = [mean, std]
-                    
-        del self.patches[self.lcv[self.lcv_index]]
+        
+        #get the patch stats for the slot of each candidate label
+        for i in np.where(~np.isnan(self.patch_mean[:, self.lcv_index]))[0]:
+            self.patch_stats[i] = [self.patch_mean[i, self.lcv_index], self.patch_std[i, self.lcv_index]]
         
     def mrf_potentials(self):
         """Compute the MRF energy for the current low-confidence voxel. The
@@ -243,60 +1533,212 @@ class PUB_MRF:
         the prior information from the votes in the 26-voxel neighborhood."""
         
         lcv = self.lcv[self.lcv_index]
-        n = self.neighbors[lcv]
-        lcv_coord = np.unravel_index(lcv, self.label_shape)
-        
-        weight = []
-        for neighbor in n: #compute the weights of the neighbors
-            neighbor_coord = np.unravel_index(neighbor, self.label_shape)
-            weight.append(self.alpha*np.exp(-self.beta*np.linalg.norm(np.subtract(neighbor_coord, lcv_coord))))
-        weight = np.asarray(weight)
-        
-        mrf_energy = np.zeros(self.label_values.shape) + np.inf            
-        for value in self.patch_stats.keys(): #compute doubleton and singleton potentials
-            (mean, std) = self.patch_stats[value]
+        neighbor_votes = self.counter.gather_labels(self.lcv_labels[:, self.lcv_index, None], lcv + self.neighbor_offsets)
+        
+        mrf_energy = np.zeros(self.lcv_labels.shape[0]) + np.inf            
+        for i in self.patch_stats.keys(): #compute doubleton and singleton potentials
+            (mean, std) = self.patch_stats[i]
             mrf_single = (np.log(np.sqrt(2*np.pi)*std)) + (np.power(self.intensity[lcv]-mean,2))/(2*np.power(std,2))
-            mrf_double = np.dot(0.5 - self.probability[np.where(self.label_values==value),n][0], weight)
-            mrf_energy[np.where(self.label_values==value)] = mrf_single + mrf_double
+            mrf_double = np.dot(0.5 - self.prob_lut[neighbor_votes[i]], self.neighbor_weights)
+            mrf_energy[i] = mrf_single + mrf_double
             
             if self.potential_maps: #update the potential map arrays
-                self.singleton[np.where(self.label_values == value), self.lcv_index] = mrf_single
-                self.doubleton[np.where(self.label_values == value), self.lcv_index] = mrf_double
+                self.singleton[i, self.lcv_index] = mrf_single
+                self.doubleton[i, self.lcv_index] = mrf_double
             
         if self.potential_maps:
             self.energy[:, self.lcv_index] = np.where(mrf_energy == np.inf, -10.0, mrf_energy)
             
-        if np.sum(np.exp(-mrf_energy)) > 0:
-            self.new_probability[:, lcv] = np.exp(-mrf_energy) / np.sum(np.exp(-mrf_energy)) #update the probabilities
+        if np.sum(np.exp(-mrf_energy)) > 0: #update the probabilities
+            self.lcv_probability[:, self.lcv_index] = np.exp(-mrf_energy) / np.sum(np.exp(-mrf_energy))
+        
+        del self.patch_stats
+        
+    def mrf_potentials_batch(self, start, stop):
+        """Compute the MRF energies of the low-confidence voxels from index
+        start to index stop in the list, and return their updated probabilities
+        with a mask of the voxels which can be updated. This gives the same
+        result as mrf_potentials for each of these voxels, but the energies of
+        all the voxels and all the candidate labels are computed as arrays of
+        shape (number of slots, stop - start)."""
+        
+        if self.backend == "numba":
+            return self.mrf_potentials_compiled(start, stop)
+        
+        lcv = self.lcv[start:stop]
+        
+        #labels without patch stats get an infinite energy
+        mean = self.patch_mean[:, start:stop]
+        std = self.patch_std[:, start:stop]
+        mrf_single = np.log(np.sqrt(2*np.pi)*std) + np.power(self.intensity[lcv]-mean,2)/(2*np.power(std,2))
+        
+        #only the votes of the candidate labels of each voxel are gathered over its neighborhood
+        neighbor_votes = self.counter.gather_labels(self.lcv_labels[:, start:stop, None], lcv[:, None] + self.neighbor_offsets)
+        mrf_double = np.dot(0.5 - self.prob_lut[neighbor_votes], self.neighbor_weights)
+        
+        has_stats = ~np.isnan(mrf_single)
+        mrf_energy = np.where(has_stats, mrf_single + mrf_double, np.inf)
+        
+        if self.potential_maps: #update the potential map arrays
+            self.singleton[:, start:stop] = np.where(has_stats, mrf_single, -10.0)
+            self.doubleton[:, start:stop] = np.where(has_stats, mrf_double, -10.0)
+            self.energy[:, start:stop] = np.where(has_stats, mrf_energy, -10.0)
+        
+        probability = np.exp(-mrf_energy)
+        total = np.sum(probability, axis=0)
+        updated = total > 0
+        probability[:, updated] /= total[updated]
+        
+        return probability, updated
+        
+    def mrf_potentials_compiled(self, start, stop):
+        """Same as mrf_potentials_batch, with the compiled kernel."""
         
-        del self.candidate_labels[lcv], self.neighbors[lcv], self.patch_stats
+        probability = np.zeros((self.lcv_labels.shape[0], stop - start))
+        updated = np.zeros(stop - start, dtype=np.bool_)
+        if self.potential_maps: #contiguous chunks, copied back below
+            maps = tuple(np.ascontiguousarray(getattr(self, name)[:, start:stop]) for name in ("singleton", "doubleton", "energy"))
+        else: #contiguous placeholders of the same type
+            maps = (np.zeros((0, 0), dtype=np.float32),)*3
+            
+        #the column slices are copied to contiguous arrays, so that Numba compiles a single
+        #specialization of the kernel for each vote count type
+        get_compiled_kernel()(np.asarray(self.counter.votes), self.lcv[start:stop], np.ascontiguousarray(self.lcv_labels[:, start:stop]),
+                          self.neighbor_offsets, self.neighbor_weights,
+                          self.prob_lut, np.asarray(self.intensity), np.ascontiguousarray(self.patch_mean[:, start:stop]),
+                          np.ascontiguousarray(self.patch_std[:, start:stop]), probability, updated, *maps, self.potential_maps)
+        
+        if self.potential_maps:
+            for name, values in zip(("singleton", "doubleton", "energy"), maps):
+                getattr(self, name)[:, start:stop] = values
+        
+        return probability, updated
+        
+    def update_probability(self, start, probability, updated):
+        """Update the probabilities of the low-confidence voxels from index
+        start in the list, with the output of mrf_potentials_batch."""
+        
+        self.lcv_probability[:, start + np.where(updated)[0]] = probability[:, updated]
+            
+    def mrf_potentials_parallel(self, chunks):
+        """Run mrf_potentials_batch on the chunks of low-confidence voxels
+        with self.jobs worker processes. The arrays used by the workers are
+        placed in shared memory, and each worker writes the probabilities of
+        its chunks to a shared output array. The chunks are the same as in a
+        serial run, so the result does not depend on the number of jobs."""
+        
+        shared = SharedArrays()
+        try:
+            model_specs = {}
+            for name in ("lcv", "lcv_labels", "intensity", "patch_mean", "patch_std"):
+                model_specs[name] = shared.share(getattr(self, name))
+                
+            posterior, model_specs["posterior"] = shared.empty(self.lcv_labels.shape, np.float64)
+            updated, model_specs["updated"] = shared.empty(self.lcv.shape[0], np.bool_)
+            
+            maps = {}
+            if self.potential_maps: #the workers fill the potential maps directly
+                for name in ("singleton", "doubleton", "energy"):
+                    maps[name], model_specs[name] = shared.empty(getattr(self, name).shape, np.float32)
+                    maps[name][...] = getattr(self, name)
+                
+            counter_specs = {}
+            counter_params = {}
+            for name, value in self.counter.__dict__.items():
+                if name == "voxels": #not needed to gather the votes
+                    continue
+                elif isinstance(value, np.ndarray):
+                    counter_specs[name] = shared.share(value)
+                else:
+                    counter_params[name] = value
+                    
+            params = {"counter": counter_params, "label_values": self.label_values, "prob_lut": self.prob_lut,
+                      "neighbor_offsets": self.neighbor_offsets, "neighbor_weights": self.neighbor_weights,
+                      "potential_maps": self.potential_maps, "backend": self.backend}
+                
+            #the threads of a Numba kernel which already ran in this process would hang forked workers
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(start_method)
+            #a worker which fails to start breaks the pool with BrokenProcessPool, instead of being restarted
+            with ProcessPoolExecutor(self.jobs, mp_context=context, initializer=init_mrf_worker,
+                                     initargs=(model_specs, counter_specs, type(self.counter), params)) as pool:
+                for n in pool.map(run_mrf_worker, chunks):
+                    pass
+                
+            self.update_probability(0, posterior, updated)
+            for name, array in maps.items():
+                setattr(self, name, array.copy())
+            del posterior, updated, maps
+            
+        finally:
+            shared.close()
         
     def get_output_image(self):
         """Return the final segmentation as a SimpleITK image. The algorithm
-        assigns the majority vote output to all the high-confidence voxels."""
+        assigns the majority vote output to all the high-confidence voxels,
+        which is taken directly from the vote counts, and the argmax of the
+        posterior probabilities to the low-confidence voxels."""
+        
+        return self.get_label_image(self.get_output_array())
+        
+    def get_output_array(self):
+        """Return the label indices of the final segmentation in the bounding
+        box, as a flat array."""
         
         if self.verbose:
             print("Obtaining final segmentation...")
         
-        labels = np.zeros(self.label_shape, dtype=np.uint8)
-        mode_arg = np.argmax(self.new_probability, axis=0).reshape(self.label_shape)
-              
-        for i, value in enumerate(self.label_values): #assign the labels with maximum probability
-            labels[np.where(mode_arg == i)] = value
+        mode_arg = self.counter.mode() #majority vote, except at the low-confidence voxels
+        if not self.no_lcv: #the first slot of the largest probability has the smallest label index
+            slot = np.argmax(self.lcv_probability, axis=0)
+            mode_arg[self.lcv] = self.lcv_labels[slot, np.arange(self.lcv.shape[0])]
+        
+        return mode_arg
+        
+    def get_majority_vote_image(self):
+        """Return the majority vote segmentation as a SimpleITK image, from
+        the same vote counts. Ties go to the smallest label value."""
         
-        #pad the bounding box with background labels
-        if self.bbox is not None:        
-            labels = np.pad(labels, ((self.bbox[2], self.brainimg.GetDepth() - self.bbox[5]),
-                            (self.bbox[1], self.brainimg.GetHeight() - self.bbox[4]),
-                            (self.bbox[0], self.brainimg.GetWidth() - self.bbox[3])),
-                            "constant", constant_values=0)
+        return self.get_label_image(self.counter.mode())
+        
+    def get_lcv_mask_image(self):
+        """Return a full size uint8 image which is 1 at the low-confidence
+        voxels and 0 everywhere else."""
+        
+        return self.get_dense_map(1, fill=0, dtype=np.uint8)
+        
+    def get_label_image(self, mode_arg):
+        """Return a SimpleITK image with the label values of the label indices
+        in the bounding box, and background labels everywhere else."""
         
         #get the output SimpleITK image with fusion labels        
-        output_image = sitk.GetImageFromArray(labels)
-        output_image.CopyInformation(self.brainimg) #copy the metadata
+        output_image = sitk.GetImageFromArray(self.get_label_array(mode_arg))
+        copy_information(output_image, self.brainimg) #copy the metadata
         
         return output_image
         
+    def get_label_array(self, mode_arg):
+        """Return a full size array with the label values of the label indices
+        in the bounding box, and background labels everywhere else."""
+        
+        #narrowest integer type for the integer range of the label values, with the background label,
+        #also for float candidate images
+        dtype = np.result_type(np.min_scalar_type(int(min(self.label_values.min(), 0))), 
+                               np.min_scalar_type(int(self.label_values.max())))
+        if dtype.kind not in "iu": #no integer type holds both ends
+            dtype = np.dtype(np.int32)
+        label_lut = self.label_values.astype(dtype) #map the label indices to the label values
+        
+        #write the bounding box in a full size image of background labels
+        if self.bbox is None:
+            labels = label_lut[mode_arg].reshape(self.label_shape)
+        else:
+            labels = np.zeros(self.brainimg.GetSize()[::-1], dtype=dtype)
+            labels[self.bbox[2]:self.bbox[5], self.bbox[1]:self.bbox[4], 
+                   self.bbox[0]:self.bbox[3]] = label_lut[mode_arg].reshape(self.label_shape)
+        
+        return labels
+        
     def get_potential_maps(self):
         """Get the singleton, prior and doubleton potential maps for each
         label. This is optional and will not occur by default, but it could
@@ -304,61 +1746,95 @@ class PUB_MRF:
         updated."""
         
         self.potentials = {}
+        maps = dict((name, self.get_label_rows(getattr(self, name), fill=-10.0)) for name in ("singleton", "doubleton", "energy"))
         
-        for value in self.label_values:
-            singleton_map = np.zeros(self.probability.shape[1], dtype=np.float32) - 10.0 #get the singleton map
-            singleton_map[self.lcv] = self.singleton[np.where(self.label_values == value)][0]
-            
-            singleton_map = singleton_map.reshape(self.label_shape)
-            singleton_map = np.pad(singleton_map, ((self.bbox[2], self.brainimg.GetDepth() - self.bbox[5]),
-                            (self.bbox[1], self.brainimg.GetHeight() - self.bbox[4]),
-                            (self.bbox[0], self.brainimg.GetWidth() - self.bbox[3])),
-                            "constant", constant_values=-10.0)
-                            
-            singleton_image = sitk.GetImageFromArray(singleton_map)
-            singleton_image.CopyInformation(self.brainimg) #copy the metadata
-            self.potentials["singleton_" + str(int(value))] = singleton_image
-            
-            del singleton_map, singleton_image
-            
-            doubleton_map = np.zeros(self.probability.shape[1], dtype=np.float32) - 10.0 #get the doubleton map
-            doubleton_map[self.lcv] = self.doubleton[np.where(self.label_values == value)][0]
-            
-            doubleton_map = doubleton_map.reshape(self.label_shape)            
-            doubleton_map = np.pad(doubleton_map, ((self.bbox[2], self.brainimg.GetDepth() - self.bbox[5]),
-                            (self.bbox[1], self.brainimg.GetHeight() - self.bbox[4]),
-                            (self.bbox[0], self.brainimg.GetWidth() - self.bbox[3])),
-                            "constant", constant_values=-10.0)
-                            
-            doubleton_image = sitk.GetImageFromArray(doubleton_map)
-            doubleton_image.CopyInformation(self.brainimg) #copy the metadata
-            self.potentials["doubleton_" + str(int(value))] = doubleton_image
-            
-            del doubleton_map, doubleton_image
-            
-            energy_map = np.zeros(self.probability.shape[1], dtype=np.float32) - 10.0 #get the doubleton map
-            energy_map[self.lcv] = self.energy[np.where(self.label_values == value)][0]
-            
-            energy_map = energy_map.reshape(self.label_shape)            
-            energy_map = np.pad(energy_map, ((self.bbox[2], self.brainimg.GetDepth() - self.bbox[5]),
-                            (self.bbox[1], self.brainimg.GetHeight() - self.bbox[4]),
-                            (self.bbox[0], self.brainimg.GetWidth() - self.bbox[3])),
-                            "constant", constant_values=-10.0)
-                            
-            energy_image = sitk.GetImageFromArray(energy_map)
-            energy_image.CopyInformation(self.brainimg) #copy the metadata
-            self.potentials["energy_" + str(int(value))] = energy_image
-            
-            del energy_map, energy_image
+        for i, value in enumerate(self.label_values):
+            for name in ("singleton", "doubleton", "energy"):
+                self.potentials[name + "_" + str(int(value))] = self.get_dense_map(maps[name][i])
+                
+    def get_label_rows(self, lcv_values, fill=0.0):
+        """Return the values of the low-confidence voxels in the slots of
+        their candidate labels as an array of shape (n_labels, n_lcv), with
+        fill for the labels which are not candidates at a voxel."""
+        
+        rows = np.zeros((self.label_values.shape[0], self.lcv.shape[0]), dtype=lcv_values.dtype) + fill
+        slot, index = np.nonzero(self.lcv_labels < self.label_values.shape[0])
+        rows[self.lcv_labels[slot, index], index] = lcv_values[slot, index]
+        return rows
                 
+    def get_dense_map(self, lcv_values, fill=-10.0, dtype=np.float32):
+        """Return a full size image with the given values at the
+        low-confidence voxels, and fill everywhere else."""
+        
+        dense_map = np.full(self.brainimg.GetSize()[::-1], fill, dtype=dtype)
+        dense_map[tuple(self.get_lcv_coordinates())] = lcv_values
+        
+        dense_image = sitk.GetImageFromArray(dense_map)
+        copy_information(dense_image, self.brainimg) #copy the metadata
+        return dense_image
+        
+    def get_lcv_coordinates(self):
+        """Return the coordinates of the low-confidence voxels in the brain
+        image, as an array of shape (3, n_lcv) in the order of the arrays."""
+        
+        coord = np.array(np.unravel_index(self.lcv, self.label_shape), dtype=np.int32)
+        if self.bbox is not None: #the low-confidence voxels are indexed in the bounding box
+            coord += np.array([self.bbox[2], self.bbox[1], self.bbox[0]], dtype=np.int32)[:, None]
+        return coord
+        
+    def save_potential_maps(self, filename):
+        """Save the potential maps in a single compressed .npz file. Instead
+        of full size images, the file keeps the coordinates of the
+        low-confidence voxels in the brain image, with the singleton,
+        doubleton, energy and posterior values of each label at these voxels
+        as arrays of shape (n_labels, n_lcv). The metadata of the brain image
+        is also kept, so that read_potential_map can rebuild the dense
+        images."""
+        
+        np.savez_compressed(filename, coordinates=self.get_lcv_coordinates(), label_values=self.label_values,
+                            singleton=self.get_label_rows(self.singleton, fill=-10.0), 
+                            doubleton=self.get_label_rows(self.doubleton, fill=-10.0),
+                            energy=self.get_label_rows(self.energy, fill=-10.0),
+                            posterior=self.get_label_rows(self.lcv_probability).astype(np.float32),
+                            size=self.brainimg.GetSize(), origin=self.brainimg.GetOrigin(), 
+                            spacing=self.brainimg.GetSpacing(), direction=self.brainimg.GetDirection())
+        
+def read_potential_map(filename, name, value, fill=-10.0):
+    """Return the dense map of a label as a SimpleITK image from a file
+    written by PUB_MRF.save_potential_maps. The name is one of singleton,
+    doubleton, energy or posterior, and the voxels which are not in the
+    low-confidence region get the fill value."""
+    
+    with np.load(filename) as potentials:
+        i = np.where(potentials["label_values"] == value)[0]
+        if i.shape[0] == 0:
+            raise ValueError("Label {} is not in {}.".format(value, filename))
+            
+        dense_map = np.zeros(potentials["size"][::-1], dtype=np.float32) + fill
+        dense_map[tuple(potentials["coordinates"])] = potentials[name][i[0]]
+        
+        dense_image = sitk.GetImageFromArray(dense_map)
+        dense_image.SetOrigin(tuple(potentials["origin"]))
+        dense_image.SetSpacing(tuple(potentials["spacing"]))
+        dense_image.SetDirection(tuple(potentials["direction"]))
+        
+    return dense_image
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Run PUB-MRF with the command line arguments, or with argv if it is given."""
+    
     #PUB-MRF parameters
     def positive_int(x): #avoid nonsense negative parameter values   
         x = int(x)
         if x < 0:
             raise ArgumentTypeError("%r is not a positive int"%(x,))
         return x
+        
+    def strictly_positive_int(x): #for counts which can't be zero
+        x = int(x)
+        if x < 1:
+            raise ArgumentTypeError("%r is not a strictly positive int"%(x,))
+        return x
             
     def restricted_float(x): #avoid nonsense values for the threshold
         x = float(x)
@@ -394,6 +1870,22 @@ if __name__ == "__main__":
     parser.add_argument("--brain_image", type=str, required=True,
                         help="brain intensity image, required argument") #need this for the singleton potentials
     parser.add_argument("output_labels", type=str)
+    parser.add_argument("--majority_vote", default=None,
+                    help="also write the majority vote segmentation from the same votes to this file [default = %(default)s]")
+    parser.add_argument("--lcv_mask", default=None,
+                    help="also write the mask of the low-confidence voxels to this file [default = %(default)s]")
+    parser.add_argument("--alphas", type=float, nargs="+", default=None,
+                    help="""write one segmentation for each combination of these alphas, betas and thresholds,
+                    from the same patch stats, with the suffix .a<alpha>_b<beta>_t<threshold>, and the lcv mask of
+                    each threshold with the suffix .t<threshold>. The output file gets the segmentation with
+                    alpha, beta and threshold, and it is written last [default = alpha]""")
+    parser.add_argument("--betas", type=float, nargs="+", default=None,
+                    help="betas of the parameter grid [default = beta]")
+    parser.add_argument("--thresholds", type=restricted_float, nargs="+", default=None,
+                    help="thresholds of the parameter grid [default = threshold]")
+    parser.add_argument("--profile", default=None,
+                    help="""write the wall time, CPU time and peak memory of each stage, with the numbers of
+                    candidates, labels, voxels and low-confidence voxels, to this JSON file [default = %(default)s]""")
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
     cg = parser.add_mutually_exclusive_group()
     cg.add_argument("--clobber", dest="clobber", action="store_true",
@@ -403,19 +1895,90 @@ if __name__ == "__main__":
     cg.set_defaults(clobber=False)
     parser.add_argument("--potential_maps", action="store_true", default=False,
                     help="keep the MRF potential maps")
+    parser.add_argument("--potential_maps_format", choices=["images", "npz"], default="images",
+                    help="""write the potential maps as one image per map and label, or as the values at the
+                    low-confidence voxels in a single .npz file [default = %(default)s]""")
+    parser.add_argument("--streaming", action="store_true", default=False,
+                    help="""read the candidate images one at a time instead of keeping them all in memory, at most
+                    --prefetch decoded candidates are held at once""")
+    parser.add_argument("--prefetch", type=positive_int, default=None,
+                    help="""number of candidate images decoded concurrently in background threads
+                    [default = 1 with --streaming, else 4]""")
+    lg = parser.add_mutually_exclusive_group()
+    lg.add_argument("--vote_library", default=None,
+                    help="""keep each candidate and the brain image of the subject in this directory once they are
+                    decoded, so that the runs on other subsets of the same candidates don't decode them again
+                    [default = %(default)s]""")
+    lg.add_argument("--cache_dir", default=None,
+                    help="""keep the counted votes in this directory, so that the runs with the same input files
+                    and other MRF parameters skip the ingestion [default = %(default)s]""")
+    parser.add_argument("--cache_size", type=float, default=10.0,
+                    help="maximum size of the vote cache in GB, the least recently used votes are removed [default = %(default)s]")
+    parser.add_argument("--engine", choices=["batch", "voxel"], default="batch",
+                    help="""compute the MRF energies with array operations over chunks of low-confidence
+                    voxels, or one voxel at a time [default = %(default)s]""")
+    parser.add_argument("--chunk_size", type=positive_int, default=4096,
+                    help="number of low-confidence voxels per chunk with --engine batch [default = %(default)s]")
+    parser.add_argument("--backend", choices=["auto", "numpy", "numba"], default="auto",
+                    help="""backend of --engine batch, Numba is used with auto if it is installed and there are many
+                    low-confidence voxels [default = %(default)s]""")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=1,
+                    help="""number of processes for the chunks of --engine batch, when pub_mrf.main is called
+                    from a script, it must be under if __name__ == "__main__" [default = %(default)s]""")
+    parser.add_argument("--use_spacing", action="store_true", default=False,
+                    help="""use the voxel spacing of the brain image for the distances in the doubleton
+                    potential, in units of the smallest spacing""")
+    parser.add_argument("--max_labels", type=strictly_positive_int, default=None,
+                    help="""keep at most this number of candidate labels per voxel in a sparse vote
+                    representation, with an overflow table for the other labels [default = dense votes]""")
 
-    opt = parser.parse_args()
+    opt = parser.parse_args(argv)
+    if opt.prefetch is None: #streaming keeps a single decoded candidate
+        opt.prefetch = 1 if opt.streaming else 4
+    
+    def split_extension(filename): #keep the compressed NIfTI extension together
+        if filename.endswith(".nii.gz"):
+            return filename[:-7], ".nii.gz"
+        return os.path.splitext(filename)
+        
+    outputs = [opt.output_labels, opt.majority_vote, opt.lcv_mask]
+    
+    grid = opt.alphas is not None or opt.betas is not None or opt.thresholds is not None
+    if grid:
+        unsupported = [name for name, used in (("--potential_maps", opt.potential_maps), ("--engine", opt.engine != "batch"),
+                                               ("--backend", opt.backend != "auto"), ("-j/--jobs", opt.jobs != 1)) if used]
+        if unsupported:
+            sys.exit("{} not supported with --alphas, --betas or --thresholds.".format(", ".join(unsupported)))
+            
+        alphas = [opt.alpha] if opt.alphas is None else opt.alphas
+        betas = [opt.beta] if opt.betas is None else opt.betas
+        thresholds = [opt.threshold] if opt.thresholds is None else opt.thresholds
+        
+        filename, fileext = split_extension(opt.output_labels)
+        grid_outputs = [(alpha, beta, threshold, "{}.a{}_b{}_t{}{}".format(filename, alpha, beta, threshold, fileext))
+                        for alpha in alphas for beta in betas for threshold in thresholds]
+        outputs += [output[3] for output in grid_outputs]
+        
+        mask_outputs = {}
+        if opt.lcv_mask is not None: #one mask per threshold instead of lcv_mask
+            mask_filename, mask_ext = split_extension(opt.lcv_mask)
+            mask_outputs = dict((threshold, "{}.t{}{}".format(mask_filename, threshold, mask_ext)) for threshold in thresholds)
+            outputs.remove(opt.lcv_mask)
+            outputs += list(mask_outputs.values())
 
-    if not(opt.clobber) and os.path.exists(opt.output_labels):
-        sys.exit("Output file already exists; use --clobber to overwrite.")
+    for filename in outputs:
+        if not(opt.clobber) and filename is not None and os.path.exists(filename):
+            sys.exit("Output file already exists; use --clobber to overwrite.")
         
     if opt.verbose:
         initial_time = time.time()
+        
+    profiler = Profiler(enabled=opt.profile is not None) #records nothing without --profile
     
     #load volumes from input files    
-    labelimg_list = [] #list of candidate segmentation images
+    labelimg_list = [] #list of candidate segmentation images, unless they are streamed
     
-    #use this to verify if the voxel-wise computations make sense    
+    #use this to verify if the voxel-wise computations make sense
     def check_metadata(img, metadata, filename):
         if img.GetSize() != metadata["size"]:
             sys.exit("Size of {0} not the same as {1}".format(filename, opt.input_labels[0]))
@@ -428,58 +1991,135 @@ if __name__ == "__main__":
     
     if opt.verbose:
         print("PUB-MRF found {} label images.".format(len(opt.input_labels)))
-        print("Loading images from files...")
-    
-    for filename in opt.input_labels:
-        labelimg = sitk.ReadImage(filename) #get all the candidate segmentations
-        
-        structure = labelimg > 0 #find the structural voxels
-        label_shape_analysis = sitk.LabelShapeStatisticsImageFilter()
-        label_shape_analysis.SetBackgroundValue(0)
-        label_shape_analysis.Execute(structure)
-        b = label_shape_analysis.GetBoundingBox(1) #get the bounding box        
-        
-        if len(labelimg_list) == 0:        
-            metadata = {} #get the metadata of the first image
-            metadata["size"] = labelimg.GetSize()
-            metadata["origin"] = map(lambda x: round(x, 4), labelimg.GetOrigin())
-            metadata["spacing"] = labelimg.GetSpacing()
-            metadata["direction"] = labelimg.GetDirection()
-            
-            #get the first bounding box
-            bbox = [b[0], b[1], b[2], b[0]+b[3], b[1]+b[4], b[2]+b[5]]
+        print("Checking the image headers...")
+        
+    #check the metadata from the headers before reading any voxel
+    with profiler.stage("read_headers"):
+        for n, filename in enumerate(opt.input_labels + [opt.brain_image]):
+            header = read_image_information(filename)
+            if n == 0:
+                metadata = {} #get the metadata of the first image
+                metadata["size"] = header.GetSize()
+                metadata["origin"] = map(lambda x: round(x, 4), header.GetOrigin())
+                metadata["spacing"] = header.GetSpacing()
+                metadata["direction"] = header.GetDirection()
+            else: #check that the metadata is the same for each other image
+                check_metadata(header, metadata, filename)
+            del header
+    
+    #look for the votes of the same input files in the cache
+    cache, cached, library = None, None, None
+    if opt.vote_library is not None:
+        library = VoteLibrary(opt.vote_library, opt.brain_image)
+    elif opt.cache_dir is not None:
+        cache = VoteCache(opt.cache_dir, int(opt.cache_size*1e9))
+        key = cache.get_key(opt.input_labels + [opt.brain_image], opt.patch_length, opt.max_labels)
+        cached = cache.lookup(key)
+    
+    bbox = None
+    if library is not None:
+        if opt.verbose:
+            print("Loading images from the vote library...")
+        
+        with profiler.stage("read_candidates"):
+            library.add(opt.input_labels, opt.prefetch) #decode the candidates which are not in the library yet
+            try:
+                bbox = library.get_bounding_box(opt.input_labels)
+            except ValueError as e:
+                sys.exit(str(e))
+            
+        labelimg_list = opt.input_labels
+        brainimg = read_image_information(opt.brain_image) #the brain array is also in the library
+        
+    elif cached is None:
+        if opt.verbose:
+            print("Loading images from files...")
+        
+        with profiler.stage("read_candidates"):
+            #get all the candidate segmentations, the next ones are decoded in the background
+            for filename, labelimg in zip(opt.input_labels, prefetch(sitk.ReadImage, opt.input_labels, opt.prefetch)):
+                new_bbox = get_bounding_box(sitk.GetArrayViewFromImage(labelimg)) #get the bounding box
+                if new_bbox is None:
+                    sys.exit("No structure found in {}".format(filename))
+                bbox = union_bounding_box(bbox, new_bbox) #keep the union of the bounding boxes
+            
+                if not opt.streaming:
+                    labelimg_list.append(labelimg)
                 
-        else: #check that the metadata is the same for each other image
-            check_metadata(labelimg, metadata, filename)
-            
-            new_bbox = (b[0], b[1], b[2], b[0]+b[3], b[1]+b[4], b[2]+b[5])   
-            for i in range(0,3): #for each minimum bounding box index
-                if new_bbox[i] < bbox[i]:
-                    bbox[i] = new_bbox[i] #keep the new minimum
-            for i in range(3,6): #for each maximum bounding box index
-                if new_bbox[i] > bbox[i]:
-                    bbox[i] = new_bbox[i] #keep the new maximum
-        
-        labelimg_list.append(labelimg)
-  
-    brainimg = sitk.ReadImage(opt.brain_image) #get the subject brain intensity image
-    check_metadata(brainimg, metadata, opt.brain_image)
+                del labelimg
+      
+        with profiler.stage("read_brain"):
+            brainimg = sitk.ReadImage(opt.brain_image) #get the subject brain intensity image
+        
+    else: #only the metadata of the brain image is needed
+        brainimg = read_image_information(opt.brain_image)
         
     #go through the PUB-MRF steps
-    pubmrf = PUB_MRF(labelimg_list, brainimg, bbox=np.asarray(bbox), alpha=opt.alpha, beta=opt.beta, 
-                     patch_length=opt.patch_length, threshold=opt.threshold, verbose=opt.verbose, 
-                     potential_maps=opt.potential_maps)
+    if opt.streaming: #the candidate images are read again while counting the votes
+        labelimg_list = opt.input_labels
+    
+    pubmrf = PUB_MRF(labelimg_list, brainimg, bbox=None if bbox is None else np.asarray(bbox), alpha=opt.alpha, 
+                     beta=opt.beta, patch_length=opt.patch_length, threshold=opt.threshold, verbose=opt.verbose, 
+                     potential_maps=opt.potential_maps, max_labels=opt.max_labels,
+                     engine=opt.engine, chunk_size=opt.chunk_size, use_spacing=opt.use_spacing,
+                     jobs=opt.jobs, backend=opt.backend, potential_maps_format=opt.potential_maps_format,
+                     prefetch_depth=opt.prefetch, cached=cached, library=library, profiler=profiler)
+    
+    if cache is not None and cached is None:
+        with profiler.stage("store_cache"):
+            cache.store(key, pubmrf)
                        
     del labelimg_list
+    
+    #the output labels are written last in both paths, so that they mark a complete run for run_joblist
+    if opt.majority_vote is not None: #the same votes give the majority vote
+        with profiler.stage("write_majority_vote"):
+            sitk.WriteImage(pubmrf.get_majority_vote_image(), opt.majority_vote, True)
       
-    output_image = pubmrf.run()
+    if grid:
+        with profiler.stage("energy_cache"):
+            pubmrf.init_energy_cache(max(thresholds + [opt.threshold])) #the patch stats are computed once for the whole grid
+        profiler.count("grid_points", len(grid_outputs))
+            
+        for alpha, beta, threshold, filename in grid_outputs:
+            with profiler.stage("fuse"):
+                output_image = pubmrf.fuse_from_cache(alpha, beta, threshold)
+            with profiler.stage("write_output"):
+                sitk.WriteImage(output_image, filename, True)
+            
+                if threshold in mask_outputs: #once per threshold
+                    sitk.WriteImage(pubmrf.get_lcv_mask_image(), mask_outputs.pop(threshold), True)
+                    
+        #the segmentation with alpha, beta and threshold is written last, so that it marks a complete grid
+        with profiler.stage("fuse"):
+            output_image = pubmrf.fuse_from_cache(opt.alpha, opt.beta, opt.threshold)
+        with profiler.stage("write_output"):
+            sitk.WriteImage(output_image, opt.output_labels, True)
     
-    if opt.potential_maps:
-        for name, image in pubmrf.potentials.items(): #write the potential map files
-            filename, fileext = os.path.splitext(opt.output_labels)
-            sitk.WriteImage(image, filename + "." + name + fileext, True)
+    else:
+        pubmrf.compute_posteriors()
+        with profiler.stage("output"):
+            output_image = pubmrf.get_output_image()
+        
+        with profiler.stage("write_output"):
+            if opt.potential_maps and opt.potential_maps_format == "npz":
+                filename, fileext = split_extension(opt.output_labels)
+                pubmrf.save_potential_maps(filename + ".potentials.npz")
+            elif opt.potential_maps:
+                for name, image in pubmrf.potentials.items(): #write the potential map files
+                    filename, fileext = split_extension(opt.output_labels)
+                    sitk.WriteImage(image, filename + "." + name + fileext, True)
+            
+            if opt.lcv_mask is not None:
+                sitk.WriteImage(pubmrf.get_lcv_mask_image(), opt.lcv_mask, True)
+            
+            sitk.WriteImage(output_image, opt.output_labels, True) #save the result to the output file
     
-    sitk.WriteImage(output_image, opt.output_labels, True) #save the result to the output file
+    if opt.profile is not None:
+        profiler.save(opt.profile, sys.argv[1:] if argv is None else list(argv))
     
     if opt.verbose:
         print("Done in {} seconds.".format(time.time() - initial_time))
+
+if __name__ == "__main__":
+    main()
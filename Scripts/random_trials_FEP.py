@@ -16,6 +16,7 @@ input_dir = "Carolina_FEP/output/intermediate/"
 brain_dir = "Carolina_FEP/input/atlases/brains/"
 resampled_dir = "Carolina_FEP/input/atlases/resampled/"
 output_dir = "Carolina_FEP/output/fusion/"
+library_dir = "Carolina_FEP/output/vote_library/"
 template_label_dir = "Carolina_FEP/output/labels/"
 joblist = "joblist_FEP"
 joblist_jlf = "joblist_JLF_FEP"
@@ -74,10 +75,10 @@ for i, subj in enumerate(data):
                             
                     filename = str(n_atl)+"-"+str(n_tmpl)+"-"+subj+"-"+str(n_iter)+ext
                     
-                    #Print the command lines for majority vote and PUB-MRF
+                    #Print the command line for PUB-MRF, which also writes the majority vote from the same votes
                     with open(joblist, "a") as f:
-                        f.write("./majority_vote.py "+" ".join(input_files)+" "+output_dir+"majority-vote/"+filename+"\n"+
-                                "./pub_mrf.py --brain_image "+brain_dir+subj+ext+" "+" ".join(input_files)+" "+output_dir+"PUB-MRF/"+filename+"\n")
+                        f.write("./pub_mrf.py --vote_library "+library_dir+subj+" --majority_vote "+output_dir+"majority-vote/"+filename+
+                                " --brain_image "+brain_dir+subj+ext+" "+" ".join(input_files)+" "+output_dir+"PUB-MRF/"+filename+"\n")
                                 
                     with open(maget_info, "a") as f:
                         f.write("./new_script "+subj+" "+str(n_atl)+" "+str(n_tmpl)+" "+" ".join(atlases)+" "+" ".join(templates)+"\n")
\ No newline at end of file
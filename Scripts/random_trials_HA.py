@@ -36,6 +36,7 @@ input_dir = "Healthy_Aging/output/intermediate/"
 brain_dir = "Healthy_Aging/input/atlases/brains/"
 resampled_dir = "Healthy_Aging/input/atlases/resampled/"
 output_dir = "Healthy_Aging/output/fusion/"
+library_dir = "Healthy_Aging/output/vote_library/"
 template_label_dir = "Healthy_Aging/output/labels/"
 joblist = "joblist_HA"
 joblist_jlf = "joblist_JLF_HA"
@@ -87,10 +88,10 @@ for i, subj in enumerate(subjects):
                             
                     filename = str(n_atl)+"-"+str(n_tmpl)+"-"+subj+"-"+str(n_iter)+ext
                     
-                    #Print the command lines for majority vote and PUB-MRF
+                    #Print the command line for PUB-MRF, which also writes the majority vote from the same votes
                     with open(joblist, "a") as f:
-                        f.write("./majority_vote.py "+" ".join(input_files)+" "+output_dir+"majority_vote/"+filename+"\n"+
-                                "./pub_mrf.py --brain_image "+brain_dir+subj+ext+" "+" ".join(input_files)+" "+output_dir+"PUB-MRF/"+filename+"\n")
+                        f.write("./pub_mrf.py --vote_library "+library_dir+subj+" --majority_vote "+output_dir+"majority_vote/"+filename+
+                                " --brain_image "+brain_dir+subj+ext+" "+" ".join(input_files)+" "+output_dir+"PUB-MRF/"+filename+"\n")
                                 
                     with open(maget_info, "a") as f:
                         f.write("./new_script "+subj+" "+str(n_atl)+" "+str(n_tmpl)+" "+" ".join(atlases)+" "+" ".join(templates)+"\n")
\ No newline at end of file
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import multiprocessing
+import os.path
+import shlex
+import subprocess
+import sys
+import time
+import traceback
+
+#the scripts which are run in the worker processes instead of a new interpreter
+IN_PROCESS = ("pub_mrf.py", "majority_vote.py")
+
+started = None #shared flags of the started jobs, by line number, set in the workers
+
+def parse_joblist(filename):
+    """Return the jobs of a joblist file, as a list of (line number, command
+    line, arguments). Empty lines and comments are skipped."""
+
+    jobs = []
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                jobs.append((n, line, shlex.split(line)))
+    return jobs
+
+def get_output(args):
+    """Return the output file of a fusion job, which is the last argument of
+    pub_mrf.py and majority_vote.py, or None for the other commands."""
+
+    if os.path.basename(args[0]) in IN_PROCESS:
+        return args[-1]
+    return None
+
+def get_unfinished_jobs(jobs):
+    """Return the jobs whose output file doesn't exist, to resume a joblist.
+    A pub_mrf.py job which was interrupted may have written its other
+    outputs, like --majority_vote, before the output labels, so it is run
+    again with --clobber."""
+
+    unfinished = []
+    for n, line, args in jobs:
+        output = get_output(args)
+        if output is None or not os.path.exists(output):
+            if os.path.basename(args[0]) == "pub_mrf.py" and "--clobber" not in args:
+                args = args[:1] + ["--clobber"] + args[1:]
+                line = shlex.join(args)
+            unfinished.append((n, line, args))
+    return unfinished
+
+def run_job(job):
+    """Run a job in a worker process and return (line number, status,
+    seconds, message). The fusion scripts are called through their main
+    function, so the interpreter and the modules are loaded only once per
+    worker. Any error, including a sys.exit from the script, is reported
+    as a failure of this job only."""
+
+    n, line, args = job
+    if started is not None:
+        started[n] = 1
+    start = time.perf_counter()
+    try:
+        script = os.path.basename(args[0])
+        if script == "pub_mrf.py":
+            import pub_mrf
+            pub_mrf.main(args[1:])
+        elif script == "majority_vote.py":
+            import majority_vote
+            majority_vote.main(args[1:])
+        else: #other commands get their own process
+            subprocess.run(line, shell=True, check=True)
+        status, message = "ok", ""
+
+    except SystemExit as e:
+        status, message = ("ok", "") if e.code in (None, 0) else ("failed", str(e.code))
+    except Exception as e:
+        status, message = "failed", "".join(traceback.format_exception_only(type(e), e)).strip()
+
+    return n, status, time.perf_counter() - start, message
+
+def init_worker(started_flags):
+    """Keep the shared flags of the started jobs in a worker process. The
+    workers already run the jobs in parallel, so the Numba kernel of
+    pub_mrf.py uses a single thread in each of them, and so do the commands
+    which they run."""
+
+    global started
+    started = started_flags
+    os.environ["NUMBA_NUM_THREADS"] = "1" #read when Numba is imported, which the workers have not done yet
+
+def get_executor(jobs, started_flags, max_jobs_per_worker=None):
+    """Return a pool of worker processes which flag the jobs they start. The
+    workers are replaced after max_jobs_per_worker jobs if it is given, which
+    needs Python 3.11."""
+
+    #new processes, the threads of a Numba kernel which already ran in this process would hang forked workers
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    kwargs = {"initializer": init_worker, "initargs": (started_flags,), "mp_context": multiprocessing.get_context(start_method)}
+    if max_jobs_per_worker is not None:
+        kwargs["max_tasks_per_child"] = max_jobs_per_worker
+    return ProcessPoolExecutor(jobs, **kwargs)
+
+def run_pool(jobs, n_workers, started_flags, max_jobs_per_worker=None):
+    """Run jobs with a pool of worker processes, and yield the result of each
+    job as it is done. If a worker dies, the pool is broken and all of its
+    unfinished jobs get a BrokenProcessPool, so these are returned in the
+    end instead, split into the ones which had started and the others."""
+
+    for job in jobs:
+        started_flags[job[0]] = 0
+    unfinished = []
+    with get_executor(n_workers, started_flags, max_jobs_per_worker) as pool:
+        futures = dict((pool.submit(run_job, job), job) for job in jobs)
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                unfinished.append(futures[future])
+
+    unfinished.sort()
+    return [job for job in unfinished if started_flags[job[0]]], [job for job in unfinished if not started_flags[job[0]]]
+
+def run_jobs(jobs, n_workers, max_jobs_per_worker=None):
+    """Run jobs with a pool of worker processes, and yield the result of each
+    job as it is done. When a worker dies, for example when it runs out of
+    memory, the jobs which were running are run again one at a time, so that
+    only the one which kills its worker fails, and the other jobs go to a new
+    pool."""
+
+    started_flags = multiprocessing.Array("b", max([job[0] for job in jobs], default=0) + 1, lock=False)
+    pending = jobs
+    while pending:
+        suspects, pending = yield from run_pool(pending, n_workers, started_flags, max_jobs_per_worker)
+        for job in suspects:
+            suspect, unused = yield from run_pool([job], 1, started_flags)
+            if suspect or unused:
+                yield job[0], "failed", None, "the worker process died"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""Run the jobs of a joblist file written by the random_trials scripts
+                            with a pool of worker processes. The pub_mrf.py and majority_vote.py jobs are run
+                            inside the workers, which stay alive between jobs, and the other lines are run as
+                            shell commands. The jobs whose output file exists are skipped, so an interrupted
+                            joblist can be run again, and a failed job doesn't stop the others.""")
+
+    parser.add_argument("joblist", type=str)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes [default = %(default)s]")
+    parser.add_argument("--max_jobs_per_worker", type=int, default=None,
+                        help="replace each worker after this number of jobs, to release its memory [default = %(default)s]")
+    parser.add_argument("--log", type=str, default=None,
+                        help="append the line, status, time in seconds, output and error message of each job to this CSV file")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", default=True,
+                        help="also run the jobs whose output file exists")
+
+    opt = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))) #the workers import the fusion scripts from here
+
+    jobs = parse_joblist(opt.joblist)
+    if opt.resume:
+        todo = get_unfinished_jobs(jobs)
+        print("Skipping {} jobs with existing outputs.".format(len(jobs) - len(todo)))
+        jobs = todo
+
+    log, writer = None, None
+    if opt.log is not None:
+        new_log = not os.path.exists(opt.log)
+        log = open(opt.log, "a", newline="")
+        writer = csv.writer(log)
+        if new_log:
+            writer.writerow(["line", "status", "seconds", "output", "message"])
+
+    outputs = dict((job[0], get_output(job[2])) for job in jobs)
+    n_failed = 0
+    done = 0
+    initial_time = time.time()
+
+    for n, status, seconds, message in run_jobs(jobs, opt.jobs, opt.max_jobs_per_worker):
+        done += 1
+        if status != "ok":
+            n_failed += 1
+            print("Line {} failed: {}".format(n, message))
+        if seconds is None:
+            print("[{}/{}] line {} {}".format(done, len(jobs), n, status))
+        else:
+            print("[{}/{}] line {} {} in {:.2f} seconds".format(done, len(jobs), n, status, seconds))
+
+        if writer is not None:
+            writer.writerow([n, status, "" if seconds is None else "{:.3f}".format(seconds), outputs[n] or "", message])
+            log.flush()
+
+    if log is not None:
+        log.close()
+
+    print("{} jobs done, {} failed, in {:.1f} seconds.".format(len(jobs), n_failed, time.time() - initial_time))
+    if n_failed > 0:
+        sys.exit(1)
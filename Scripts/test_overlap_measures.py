@@ -0,0 +1,40 @@
+import numpy as np
+import SimpleITK as sitk
+
+from overlap_measures import get_overlap_measures
+
+def test_overlap_measures_match_itk():
+    """The measures of the confusion matrix are the ones of
+    LabelOverlapMeasuresImageFilter, for all the labels and for each label,
+    with the false positive as its false discovery rate. The label 5 is only
+    in the source and the label 6 only in the target, the measures which
+    divide by their empty volume are not defined."""
+
+    rng = np.random.RandomState(0)
+    source = rng.randint(0, 4, (6, 7, 8)).astype(np.uint8)
+    target = np.where(rng.rand(6, 7, 8) < 0.7, source, rng.randint(0, 4, (6, 7, 8))).astype(np.uint8)
+    source[0, 0, :3] = 5
+    target[1, 1, :2] = 6
+
+    itk = sitk.LabelOverlapMeasuresImageFilter()
+    itk.Execute(sitk.GetImageFromArray(source), sitk.GetImageFromArray(target))
+
+    rows = get_overlap_measures(source, target)
+    assert [row[0] for row in rows] == ["All", 1, 2, 3, 5, 6]
+    for label, total, jaccard, dice, volume_similarity, false_negative, false_positive in rows:
+        args = () if label == "All" else (label,)
+        assert np.isclose(jaccard, itk.GetJaccardCoefficient(*args))
+        assert np.isclose(dice, itk.GetDiceCoefficient(*args))
+        assert np.isclose(volume_similarity, itk.GetVolumeSimilarity(*args))
+        if label == 5: #no target volume
+            assert np.isnan(false_negative) and np.isnan(total)
+        else:
+            assert np.isclose(false_negative, itk.GetFalseNegativeError(*args))
+        if label == 6: #no source volume
+            assert np.isnan(false_positive)
+        else:
+            assert np.isclose(false_positive, itk.GetFalseDiscoveryRate(*args))
+
+    #the false positive is |S - T| / |S|
+    inside = source == 1
+    assert np.isclose(rows[1][6], np.sum(inside & (target != 1)) / np.sum(inside))
@@ -0,0 +1,528 @@
+import numpy as np
+import SimpleITK as sitk
+import pytest
+import os
+import json
+
+import majority_vote
+import pub_mrf
+from pub_mrf import (PUB_MRF, SparseVoteCounter, VoteCache, VoteCounter, VoteLibrary, fuse, get_bounding_box,
+                     read_image_array, read_image_information, read_potential_map, union_bounding_box)
+from benchmark_pub_mrf import random_phantom
+
+#small phantom whose low-confidence voxels keep their patches inside of the image
+SIZE, N_LABELS, N_CANDIDATES, PATCH_LENGTH = 32, 4, 9, 3
+
+@pytest.fixture(scope="module")
+def phantom():
+    return random_phantom(SIZE, N_LABELS, N_CANDIDATES, 20.0, np.random.RandomState(0))
+
+@pytest.fixture(scope="module")
+def phantom_files(phantom, tmp_path_factory):
+    """Return the file names of the brain image and of the candidates of the
+    phantom."""
+    
+    brain, candidates = phantom
+    directory = tmp_path_factory.mktemp("phantom")
+    brain_file = str(directory / "brain.nii.gz")
+    sitk.WriteImage(brain, brain_file)
+    candidate_files = [str(directory / "candidate{}.nii.gz".format(n)) for n in range(len(candidates))]
+    for filename, img in zip(candidate_files, candidates):
+        sitk.WriteImage(img, filename)
+    return brain_file, candidate_files
+    
+def get_union_bbox(candidates):
+    """Return the bounding box of the structures of all the candidates."""
+    
+    bbox = None
+    for img in candidates:
+        bbox = union_bounding_box(bbox, get_bounding_box(sitk.GetArrayViewFromImage(img)))
+    return bbox
+    
+def fuse_labels(phantom, **params):
+    """Return the label array of a PUB-MRF run on the phantom."""
+
+    brain, candidates = phantom
+    params.setdefault("patch_length", PATCH_LENGTH)
+    model = PUB_MRF(candidates, brain, **params)
+    return sitk.GetArrayFromImage(model.run())
+
+def test_neighbor_distances(phantom):
+    """With use_spacing, the distances of the neighbors of each flat offset
+    are the physical distances between the voxels, relative to the smallest
+    spacing, and isotropic spacing gives the labels of the default."""
+    
+    brain, candidates = phantom
+    brain = sitk.Image(brain)
+    brain.SetSpacing((1.0, 2.0, 0.5))
+    model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH, use_spacing=True)
+    model.find_lcv()
+    
+    center = np.array(model.label_shape) // 2
+    distances = []
+    for offset in model.neighbor_offsets:
+        neighbor = np.unravel_index(np.ravel_multi_index(center, model.label_shape) + offset, model.label_shape)
+        a = brain.TransformIndexToPhysicalPoint([int(x) for x in center[::-1]])
+        b = brain.TransformIndexToPhysicalPoint([int(x) for x in neighbor[::-1]])
+        distances.append(np.linalg.norm(np.subtract(a, b)) / 0.5)
+    assert len(distances) == 27
+    assert np.allclose(model.get_neighbor_distances(), distances)
+    nz, ny, nx = model.label_shape
+    axis_distances = model.get_neighbor_distances()[np.searchsorted(model.neighbor_offsets, [ny*nx, nx, 1])]
+    assert np.allclose(axis_distances, [1.0, 4.0, 2.0]) #spacing of z, y and x over the smallest one
+    
+    brain.SetSpacing((2.0, 2.0, 2.0))
+    isotropic = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH, use_spacing=True)
+    assert np.array_equal(sitk.GetArrayFromImage(isotropic.run()), fuse_labels(phantom))
+    
+def test_integer_counts_match_float_votes(phantom):
+    """The integer vote counts give the same prior probabilities, majority
+    vote and low-confidence voxels as float votes counted per label."""
+
+    brain, candidates = phantom
+    model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH)
+    model.find_lcv()
+
+    #float reference: one scan per label and per image, as the original Scripts/pub_mrf.py did
+    label_arrays = [sitk.GetArrayFromImage(img).ravel() for img in candidates]
+    votes = np.zeros((model.label_values.shape[0], label_arrays[0].shape[0]), dtype=np.float32)
+    for label_array in label_arrays:
+        for i, value in enumerate(model.label_values):
+            votes[i][np.where(label_array == value)] += 1
+    probability = np.array(votes / len(label_arrays), dtype=np.float32)
+
+    assert np.array_equal(model.prob_lut[model.counter.votes], probability)
+    assert np.array_equal(model.counter.mode(), np.argmax(probability, axis=0))
+
+    n_labels = np.sum(probability > 0, axis=0)
+    lcv = np.where((n_labels > 1) & (np.amax(probability, axis=0) < 1.0/n_labels + model.threshold))[0]
+    assert lcv.shape[0] > 0
+    assert np.array_equal(model.lcv, lcv)
+
+def get_old_patch_stats(model):
+    """Return the weighted patch stats of the candidate labels of each
+    low-confidence voxel, computed patch by patch from the sorted
+    probabilities like the original Scripts/pub_mrf.py did, with NaN for the
+    labels without stats."""
+    
+    p = model.patch_length
+    probability = model.prob_lut[model.counter.votes]
+    sorted_prob = np.sort(probability, axis=0)[::-1] #sort in descending order
+    mean = np.zeros((model.label_values.shape[0], model.lcv.shape[0])) + np.nan
+    std = np.zeros((model.label_values.shape[0], model.lcv.shape[0])) + np.nan
+    
+    for n, lcv in enumerate(model.lcv):
+        corner = np.array(np.unravel_index(lcv, model.label_shape)) - p
+        patch = np.ravel_multi_index(np.indices((2*p + 1,)*3).reshape(3, -1) + corner[:, None], model.label_shape)
+        intensity = model.intensity[patch]
+        for i in np.nonzero(probability[:, lcv])[0]:
+            weight = np.equal(probability[i, patch], sorted_prob[0, patch]) * (sorted_prob[0, patch] - sorted_prob[1, patch])
+            if np.sum(weight) > 0.0:
+                m = np.sum(intensity * weight) / np.sum(weight)
+                s = np.sqrt(np.sum(np.power(intensity - m, 2)*weight) / np.sum(weight))
+                if s != 0.0:
+                    mean[i, n], std[i, n] = m, s
+    return mean, std
+    
+@pytest.mark.filterwarnings("ignore:Labels in image")
+def test_patch_stats_match_sorted_probabilities(phantom):
+    """The patch stats from the summed-area tables are the ones computed
+    patch by patch. In the background corner, the label 4 has most of the
+    votes at a single voxel next to a low-confidence voxel, so the only
+    weighted voxel of its patch gives a standard deviation which is 0 up to
+    the rounding of the float32 weighted mean. The patch by patch stats keep
+    it, while init_patch_stats finds it from the extreme intensities and
+    leaves the label without stats."""
+    
+    brain, candidates = phantom
+    arrays = [sitk.GetArrayFromImage(img) for img in candidates]
+    for n, array in enumerate(arrays):
+        array[5, 5, 5] = (4, 1, 0)[n*3 // len(arrays)] #a low-confidence voxel
+        if n < 2*len(arrays) // 3:
+            array[5, 5, 6] = 4
+    
+    model = PUB_MRF([sitk.GetImageFromArray(a) for a in arrays], brain, patch_length=PATCH_LENGTH)
+    model.find_lcv()
+    mean, std = get_old_patch_stats(model)
+    patch_mean = model.get_label_rows(model.patch_mean, fill=np.nan) #one row per label instead of the slots
+    patch_std = model.get_label_rows(model.patch_std, fill=np.nan)
+    
+    single = np.where(model.lcv == np.ravel_multi_index((5, 5, 5), model.label_shape))[0][0]
+    assert 0.0 < std[4, single] < 1e-4 and np.isnan(patch_std[4, single])
+    
+    degenerate = std < 1e-4 #the intensities are about 100 apart
+    assert np.array_equal(np.isnan(patch_mean), np.isnan(mean) | degenerate)
+    valid = ~np.isnan(mean) & ~degenerate
+    assert valid.sum() > 1000
+    assert np.allclose(patch_mean[valid], mean[valid], rtol=1e-5, atol=1e-3)
+    assert np.allclose(patch_std[valid], std[valid], rtol=1e-5, atol=1e-3)
+    
+def get_reference_labels(candidates, brain, alpha, beta, patch_length, threshold):
+    """Return the label array of the per-voxel PUB-MRF of the original
+    Scripts/pub_mrf.py, with the float votes, the patches and neighborhoods
+    of ravel_multi_index and the patch stats of the sorted probabilities."""
+    
+    label_arrays = [sitk.GetArrayFromImage(img) for img in candidates]
+    label_values = np.unique(label_arrays[0])
+    label_shape = label_arrays[0].shape
+    votes = np.zeros((label_values.shape[0], label_arrays[0].size), dtype=np.float32)
+    for label_array in label_arrays:
+        for i, value in enumerate(label_values):
+            votes[i][np.where(label_array.ravel() == value)] += 1
+    probability = np.array(votes / len(label_arrays), dtype=np.float32)
+    new_probability = np.copy(probability)
+    intensity = sitk.GetArrayFromImage(brain).ravel()
+    
+    n_labels = np.sum(probability > 0, axis=0)
+    for lcv in np.where((n_labels > 1) & (np.amax(probability, axis=0) < 1.0/n_labels + threshold))[0]:
+        x, y, z = np.unravel_index(lcv, label_shape)
+        neighbors = [np.ravel_multi_index((i, j, k), label_shape)
+                     for i in range(x-1, x+2) for j in range(y-1, y+2) for k in range(z-1, z+2)]
+        patch = np.asarray([np.ravel_multi_index((i, j, k), label_shape)
+                            for i in range(x-patch_length, x+patch_length+1)
+                            for j in range(y-patch_length, y+patch_length+1)
+                            for k in range(z-patch_length, z+patch_length+1)])
+        
+        patch_stats = {}
+        patch_probability = probability[:, patch]
+        sorted_prob = np.sort(patch_probability, axis=0)[::-1]
+        for value in label_values[probability[:, lcv].nonzero()]:
+            value_index = np.where(label_values == value)
+            weight = np.equal(patch_probability[value_index], sorted_prob[0]) * (sorted_prob[0] - sorted_prob[1])
+            if np.sum(weight) > 0.0:
+                mean = np.sum(intensity[patch] * weight) / np.sum(weight)
+                std = np.sqrt(np.sum(np.power(intensity[patch]-mean,2)*weight)/np.sum(weight))
+                if std != 0.0:
+                    patch_stats[value] = [mean, std]
+        
+        weight = np.asarray([alpha*np.exp(-beta*np.linalg.norm(np.subtract(np.unravel_index(neighbor, label_shape), (x, y, z))))
+                             for neighbor in neighbors])
+        mrf_energy = np.zeros(label_values.shape) + np.inf
+        for value, (mean, std) in patch_stats.items():
+            mrf_single = (np.log(np.sqrt(2*np.pi)*std)) + (np.power(intensity[lcv]-mean,2))/(2*np.power(std,2))
+            mrf_double = np.dot(0.5 - probability[np.where(label_values==value), neighbors][0], weight)
+            mrf_energy[np.where(label_values==value)] = mrf_single + mrf_double
+        if np.sum(np.exp(-mrf_energy)) > 0:
+            new_probability[:, lcv] = np.exp(-mrf_energy) / np.sum(np.exp(-mrf_energy))
+            
+    return label_values[np.argmax(new_probability, axis=0)].reshape(label_shape)
+    
+def test_reference_labels(phantom):
+    """The fused labels are the ones of the per-voxel implementation which
+    the vectorized engines replaced."""
+    
+    brain, candidates = phantom
+    params = {"alpha": 2.0, "beta": 2.7, "patch_length": PATCH_LENGTH, "threshold": 0.2}
+    assert np.array_equal(fuse_labels(phantom, **params), get_reference_labels(candidates, brain, **params))
+    
+def test_output_label_type(phantom):
+    """The output labels get the narrowest integer type of the label values,
+    so labels above 255 are kept instead of wrapping around in uint8."""
+    
+    brain, candidates = phantom
+    labels = fuse_labels(phantom)
+    assert labels.dtype == np.uint8
+    
+    candidates = [sitk.GetImageFromArray(100*sitk.GetArrayFromImage(img).astype(np.uint16)) for img in candidates]
+    large_labels = fuse_labels((brain, candidates))
+    assert large_labels.dtype == np.uint16 and large_labels.max() == 100*(N_LABELS - 1)
+    assert np.array_equal(large_labels, 100*labels.astype(np.uint16))
+    
+    #also in the full size buffer of a bounding box
+    cropped_labels = fuse_labels((brain, candidates), bbox=np.asarray(get_union_bbox(candidates)))
+    assert cropped_labels.dtype == np.uint16 and np.array_equal(cropped_labels, large_labels)
+    
+def test_voxel_and_batch_engines(phantom):
+    assert np.array_equal(fuse_labels(phantom, engine="voxel"), fuse_labels(phantom, engine="batch"))
+
+def test_numba_backend(phantom):
+    """The energy kernel of the numba backend, which is compiled if Numba is
+    installed and runs as plain Python otherwise, gives the posteriors and
+    the potential maps of the NumPy backend."""
+    
+    brain, candidates = phantom
+    models = {}
+    for backend in ("numpy", "numba"):
+        model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH, potential_maps=True, backend="numpy")
+        model.backend = backend #the constructor only accepts numba when it is installed
+        model.compute_posteriors()
+        models[backend] = model
+        
+    for name in ("lcv_probability", "singleton", "doubleton", "energy"):
+        assert np.allclose(getattr(models["numba"], name), getattr(models["numpy"], name), rtol=1e-5, atol=1e-6), name
+    
+def test_potential_map_npz(phantom, tmp_path):
+    """The dense maps rebuilt from the npz file are the potential maps of the
+    images format, with the metadata of the brain image, also when the
+    low-confidence voxels are indexed in a bounding box."""
+    
+    brain, candidates = phantom
+    brain = sitk.Image(brain)
+    brain.SetSpacing((1.0, 1.2, 0.8))
+    brain.SetOrigin((-10.0, 5.0, 2.5))
+    bbox = get_union_bbox(candidates)
+    
+    models = {}
+    for potential_maps_format in ("images", "npz"):
+        models[potential_maps_format] = PUB_MRF(candidates, brain, bbox=np.asarray(bbox), patch_length=PATCH_LENGTH,
+                                                potential_maps=True, potential_maps_format=potential_maps_format)
+        models[potential_maps_format].run()
+    models["npz"].save_potential_maps(str(tmp_path / "potentials.npz"))
+    
+    for value in models["npz"].label_values:
+        for name in ("singleton", "doubleton", "energy"):
+            dense_image = read_potential_map(str(tmp_path / "potentials.npz"), name, value)
+            reference = models["images"].potentials[name + "_" + str(value)]
+            assert np.array_equal(sitk.GetArrayFromImage(dense_image), sitk.GetArrayFromImage(reference))
+            for getter in ("GetOrigin", "GetSpacing", "GetDirection"):
+                assert getattr(dense_image, getter)() == getattr(reference, getter)()
+    with pytest.raises(ValueError):
+        read_potential_map(str(tmp_path / "potentials.npz"), "energy", N_LABELS + 1)
+        
+def test_auto_backend(phantom, monkeypatch):
+    """The auto backend only uses the compiled kernel for many low-confidence
+    voxels, if Numba is installed."""
+    
+    brain, candidates = phantom
+    for min_compiled_lcv, backend in ((10**9, "numpy"), (0, "numba" if pub_mrf.numba_installed else "numpy")):
+        monkeypatch.setattr(PUB_MRF, "min_compiled_lcv", min_compiled_lcv)
+        model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH)
+        model.compute_posteriors()
+        assert model.backend == backend
+        
+@pytest.fixture(scope="module")
+def energy_cache(phantom):
+    brain, candidates = phantom
+    model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH)
+    model.init_energy_cache(0.5)
+    return model
+    
+@pytest.mark.filterwarnings("ignore:No low-confidence voxel")
+@pytest.mark.parametrize("alpha, beta, threshold", [(2.0, 2.7, 0.2), (0.5, 1.0, 0.35), (4.0, 0.0, 0.5), (2.0, 2.7, 0.0)])
+def test_fuse_from_cache(phantom, energy_cache, alpha, beta, threshold):
+    """The energy cache gives the segmentation of a run with the same
+    parameters, also without any low-confidence voxel at threshold 0."""
+    
+    labels = sitk.GetArrayFromImage(energy_cache.fuse_from_cache(alpha, beta, threshold))
+    assert np.array_equal(labels, fuse_labels(phantom, alpha=alpha, beta=beta, threshold=threshold))
+    assert energy_cache.no_lcv == (threshold == 0.0)
+    
+def test_jobs(phantom):
+    assert np.array_equal(fuse_labels(phantom, jobs=1), fuse_labels(phantom, jobs=3, chunk_size=256))
+
+@pytest.mark.parametrize("max_labels", [1, 2])
+def test_sparse_votes(phantom, max_labels):
+    assert np.array_equal(fuse_labels(phantom), fuse_labels(phantom, max_labels=max_labels))
+
+@pytest.mark.parametrize("crop", [True, False])
+def test_fuse_arrays(phantom, crop):
+    """The array interface gives the labels of a PUB-MRF run on the images,
+    and the posteriors of the low-confidence voxels at their coordinates."""
+    
+    brain, candidates = phantom
+    arrays = [sitk.GetArrayFromImage(img) for img in candidates]
+    labels, posteriors = fuse(arrays, sitk.GetArrayFromImage(brain), crop=crop, patch_length=PATCH_LENGTH)
+    assert np.array_equal(labels, fuse_labels(phantom))
+    
+    coordinates = tuple(posteriors["coordinates"])
+    assert posteriors["probability"].shape == (posteriors["label_values"].shape[0], coordinates[0].shape[0])
+    assert np.array_equal(labels[coordinates], posteriors["label_values"][np.argmax(posteriors["probability"], axis=0)])
+
+def test_sparse_candidates():
+    """The sparse counter gives the candidate labels and the votes of given
+    labels of the dense counter, also from its overflow table."""
+    
+    rng = np.random.RandomState(1)
+    dense, sparse = VoteCounter(np.arange(12), 500), SparseVoteCounter(np.arange(12), 500, max_labels=2)
+    for n in range(15):
+        label_array = np.where(rng.rand(500) < 0.5, rng.randint(0, 3, 500), rng.randint(0, 12, 500))
+        dense.add(label_array)
+        sparse.add(label_array)
+    assert sparse.overflow_voxels.shape[0] > 0
+    
+    index = rng.randint(0, 500, 200)
+    labels, counts = dense.candidates(index)
+    assert np.array_equal(counts.sum(axis=0), dense.votes[:, index].sum(axis=0)) #every label with votes
+    assert np.array_equal(counts, np.where(labels < 12, dense.votes[np.minimum(labels, 11), index], 0))
+    assert (np.diff(labels, axis=0) >= 0).all() and (counts[labels < 12] > 0).all()
+    assert np.array_equal(sparse.candidates(index)[0], labels)
+    assert np.array_equal(sparse.candidates(index)[1], counts)
+    
+    labels = rng.randint(0, 13, (4, 200, 1)) #with the empty label index 12
+    neighbors = (index[:, None] + np.arange(3)) % 500
+    assert np.array_equal(sparse.gather_labels(labels, neighbors), dense.gather_labels(labels, neighbors))
+    assert np.array_equal(dense.gather_labels(labels, neighbors), np.where(labels < 12, dense.votes[np.minimum(labels, 11), neighbors], 0))
+
+def test_read_bounding_box(phantom, phantom_files):
+    """The candidate files are read within the bounding box, and the votes
+    counted from the files give the labels of the votes of the images."""
+    
+    brain, candidates = phantom
+    brain_file, candidate_files = phantom_files
+    bbox = get_union_bbox(candidates)
+    array = sitk.GetArrayFromImage(candidates[0])
+    assert np.array_equal(read_image_array(candidate_files[0], bbox), array[bbox[2]:bbox[5], bbox[1]:bbox[4], bbox[0]:bbox[3]])
+    assert np.array_equal(read_image_array(candidate_files[0]), array)
+    
+    model = PUB_MRF(candidate_files, brain, bbox=np.asarray(bbox), patch_length=PATCH_LENGTH)
+    assert model.label_shape != array.shape
+    assert np.array_equal(sitk.GetArrayFromImage(model.run()), fuse_labels(phantom, bbox=np.asarray(bbox)))
+    
+@pytest.mark.parametrize("streaming", [[], ["--streaming", "--prefetch", "2"]])
+def test_main(phantom, phantom_files, tmp_path, streaming):
+    """The command line gives the labels of the run on the images within the
+    bounding box of the candidates, also when the candidates are streamed
+    from the files with two of them decoded ahead."""
+    
+    brain, candidates = phantom
+    brain_file, candidate_files = phantom_files
+    output = str(tmp_path / "output.nii.gz")
+    pub_mrf.main(["-p", str(PATCH_LENGTH)] + streaming + ["--brain_image", brain_file] + candidate_files + [output])
+    labels = fuse_labels(phantom, bbox=np.asarray(get_union_bbox(candidates)))
+    assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(output)), labels)
+    
+def test_main_majority_vote(phantom, phantom_files, tmp_path):
+    """The majority vote of the command line is the output of
+    majority_vote.py, and the lcv mask marks the low-confidence voxels."""
+    
+    brain, candidates = phantom
+    brain_file, candidate_files = phantom_files
+    output, votes, mask = (str(tmp_path / name) for name in ("output.nii.gz", "votes.nii.gz", "mask.nii.gz"))
+    pub_mrf.main(["-p", str(PATCH_LENGTH), "--majority_vote", votes, "--lcv_mask", mask, "--brain_image", brain_file]
+                 + candidate_files + [output])
+    majority_vote.main(candidate_files + [str(tmp_path / "reference.nii.gz")])
+    reference = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "reference.nii.gz")))
+    assert np.count_nonzero(sitk.GetArrayFromImage(sitk.ReadImage(votes)) != reference) == 0
+    
+    model = PUB_MRF(candidates, brain, bbox=np.asarray(get_union_bbox(candidates)), patch_length=PATCH_LENGTH)
+    model.find_lcv()
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(mask))
+    assert mask.shape == reference.shape and mask.sum() == model.lcv.shape[0] > 0
+    
+def test_main_profile(phantom, phantom_files, tmp_path):
+    """The --profile report has the keys of the pub_mrf.profile/1 schema, a
+    record of each stage of the run and the counts of the model."""
+    
+    brain, candidates = phantom
+    brain_file, candidate_files = phantom_files
+    argv = ["-p", str(PATCH_LENGTH), "--profile", str(tmp_path / "profile.json"), "--brain_image", brain_file]
+    argv += candidate_files + [str(tmp_path / "output.nii.gz")]
+    pub_mrf.main(argv)
+    with open(str(tmp_path / "profile.json")) as f:
+        report = json.load(f)
+    
+    assert report["schema"] == "pub_mrf.profile/1" and report["command"] == argv
+    assert set(report) == {"schema", "command", "total", "stages", "counts"}
+    assert set(report["total"]) == {"wall_seconds", "cpu_seconds", "peak_rss_mb"}
+    for record in report["stages"]:
+        assert set(record) == {"name", "parent", "wall_seconds", "cpu_seconds", "peak_rss_delta_mb", "peak_rss_mb"}
+        assert record["wall_seconds"] >= 0.0
+    names = set(record["name"] for record in report["stages"])
+    assert names >= {"read_headers", "read_candidates", "read_brain", "count_votes", "find_lcv", "mrf_potentials",
+                     "output", "write_output"}
+    
+    model = PUB_MRF(candidates, brain, bbox=np.asarray(get_union_bbox(candidates)), patch_length=PATCH_LENGTH)
+    model.find_lcv()
+    counts = report["counts"]
+    assert counts["candidates"] == N_CANDIDATES and counts["labels"] == N_LABELS
+    assert counts["bbox_voxels"] == np.prod(model.label_shape) < SIZE**3
+    assert counts["lcv"] == model.lcv.shape[0] > 0
+    
+@pytest.mark.parametrize("max_labels", [None, 2])
+def test_vote_cache(phantom, tmp_path, max_labels):
+    """A run on the votes of the cache, which are memory-mapped, gives the
+    labels of a run which counts them."""
+    
+    brain, candidates = phantom
+    sitk.WriteImage(brain, str(tmp_path / "brain.nii.gz"))
+    cache = VoteCache(str(tmp_path / "cache"), int(1e9))
+    key = cache.get_key([str(tmp_path / "brain.nii.gz")], PATCH_LENGTH, max_labels)
+    assert cache.lookup(key) is None
+    
+    model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH, max_labels=max_labels)
+    cache.store(key, model)
+    cached = cache.lookup(key)
+    assert cached is not None
+    
+    model = PUB_MRF([], brain, patch_length=PATCH_LENGTH, max_labels=max_labels, cached=cached)
+    assert isinstance(model.intensity, np.memmap)
+    assert np.array_equal(sitk.GetArrayFromImage(model.run()), fuse_labels(phantom, max_labels=max_labels))
+    
+def test_vote_cache_eviction(phantom, tmp_path):
+    """The least recently used entries are removed first, and the entry which
+    was just stored is kept even if it is larger than the cache."""
+    
+    brain, candidates = phantom
+    model = PUB_MRF(candidates, brain, patch_length=PATCH_LENGTH)
+    cache = VoteCache(str(tmp_path), int(1e9))
+    cache.store("a", model)
+    os.utime(cache.lookup("a"), (1000, 1000))
+    cache.store("b", model)
+    os.utime(cache.lookup("b"), (2000, 2000))
+    cache.lookup("a") #now the most recently used
+    
+    entry_size = sum(os.path.getsize(os.path.join(cache.lookup("a"), f)) for f in os.listdir(cache.lookup("a")))
+    cache.max_bytes = 2*entry_size
+    cache.store("c", model)
+    assert sorted(os.listdir(str(tmp_path))) == ["a", "c"]
+    
+    cache.max_bytes = 0
+    cache.store("d", model)
+    assert os.listdir(str(tmp_path)) == ["d"]
+
+@pytest.fixture
+def vote_library(phantom, tmp_path):
+    """Return a vote library of the phantom with an extra candidate without
+    structure, and the file names of the candidates."""
+    
+    brain, candidates = phantom
+    sitk.WriteImage(brain, str(tmp_path / "brain.nii.gz"))
+    filenames = []
+    for n, img in enumerate(candidates + [sitk.Image(brain.GetSize(), sitk.sitkUInt8)]):
+        filenames.append(str(tmp_path / "candidate{}.nii.gz".format(n)))
+        sitk.WriteImage(img, filenames[-1])
+    
+    library = VoteLibrary(str(tmp_path / "library"), str(tmp_path / "brain.nii.gz"))
+    library.add(filenames)
+    return library, filenames
+    
+def test_vote_library_subset(phantom, vote_library):
+    """A trial on a subset of the candidates of the library gives the labels
+    of a run which decodes them, and the brain array is taken within the
+    bounding box of the subset padded with the patch length."""
+    
+    brain, candidates = phantom
+    library, filenames = vote_library
+    subset = [1, 3, 4, 6, 8]
+    
+    bbox = library.get_bounding_box([filenames[n] for n in subset])
+    reference_bbox = None
+    for n in subset:
+        reference_bbox = union_bounding_box(reference_bbox, get_bounding_box(sitk.GetArrayViewFromImage(candidates[n])))
+    assert bbox == reference_bbox
+    
+    model = PUB_MRF([filenames[n] for n in subset], read_image_information(filenames[0]), bbox=np.asarray(bbox),
+                    patch_length=PATCH_LENGTH, library=library)
+    padded = [max(x - PATCH_LENGTH, 0) for x in bbox[:3]] + [min(x + PATCH_LENGTH, SIZE) for x in bbox[3:]]
+    assert list(model.bbox) == padded and padded != [0, 0, 0] + [SIZE]*3 #only a part of the brain array
+    brain_array = sitk.GetArrayFromImage(brain)
+    assert np.array_equal(model.intensity, brain_array[padded[2]:padded[5], padded[1]:padded[4], padded[0]:padded[3]].ravel())
+    
+    labels = sitk.GetArrayFromImage(model.run())
+    reference = PUB_MRF([candidates[n] for n in subset], brain, bbox=np.asarray(bbox), patch_length=PATCH_LENGTH)
+    assert np.array_equal(labels, sitk.GetArrayFromImage(reference.run()))
+    
+def test_vote_library_without_structure(vote_library):
+    """A candidate without structure is stored as an empty array. It can't
+    give the bounding box of a trial, and it only votes for the background
+    within the bounding box of the other candidates."""
+    
+    library, filenames = vote_library
+    bbox, array = library.get_entry(filenames[-1])
+    assert bbox is None and array.shape == (0, 0, 0) and array.dtype == np.uint8
+    with pytest.raises(ValueError):
+        library.get_bounding_box(filenames)
+        
+    bbox = library.get_bounding_box(filenames[:-1])
+    label_array = library.get_label_array(filenames[-1], bbox)
+    assert label_array.shape == (bbox[5] - bbox[2], bbox[4] - bbox[1], bbox[3] - bbox[0]) and not label_array.any()
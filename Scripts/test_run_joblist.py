@@ -0,0 +1,36 @@
+import numpy as np
+import SimpleITK as sitk
+import multiprocessing
+import os.path
+
+from run_joblist import get_executor, get_unfinished_jobs, parse_joblist, run_job
+from benchmark_pub_mrf import random_phantom
+
+def test_resume_interrupted_job(tmp_path):
+    """A pub_mrf.py job which was interrupted after writing its majority
+    vote is run again on resume, and the jobs which are done are skipped."""
+
+    brain, candidates = random_phantom(16, 3, 5, 20.0, np.random.RandomState(0))
+    sitk.WriteImage(brain, str(tmp_path / "brain.nii.gz"))
+    for n, img in enumerate(candidates):
+        sitk.WriteImage(img, str(tmp_path / "candidate{}.nii.gz".format(n)))
+    candidate_files = " ".join(str(tmp_path / "candidate{}.nii.gz".format(n)) for n in range(len(candidates)))
+
+    with open(tmp_path / "joblist", "w") as f:
+        for name in ("interrupted", "done"):
+            f.write("./pub_mrf.py -p 2 --majority_vote {0}/{1}_mv.nii.gz --brain_image {0}/brain.nii.gz {2} {0}/{1}.nii.gz\n"
+                    .format(tmp_path, name, candidate_files))
+    for filename in ("interrupted_mv.nii.gz", "done_mv.nii.gz", "done.nii.gz"):
+        sitk.WriteImage(candidates[0], str(tmp_path / filename))
+
+    jobs = get_unfinished_jobs(parse_joblist(str(tmp_path / "joblist")))
+    assert [job[0] for job in jobs] == [1]
+    n, status, seconds, message = run_job(jobs[0])
+    assert status == "ok", message
+    assert os.path.exists(tmp_path / "interrupted.nii.gz")
+
+def test_worker_numba_threads():
+    """The jobs of a worker run the Numba kernel with a single thread."""
+
+    with get_executor(2, multiprocessing.Array("b", 2, lock=False)) as pool:
+        assert list(pool.map(os.getenv, ["NUMBA_NUM_THREADS"]*2)) == ["1", "1"]